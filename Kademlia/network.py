@@ -10,7 +10,7 @@ import kademlia
 from kademlia import protocol
 from kademlia import storage
 from kademlia.protocol import KademliaProtocol
-from kademlia.utils import digest
+from kademlia.utils import digest, value_size
 from kademlia.storage import ForgetfulStorage
 from kademlia.node import Node
 from kademlia.crawling import ValueSpiderCrawl
@@ -18,6 +18,13 @@ from kademlia.crawling import NodeSpiderCrawl
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+# rpcudp refuses requests larger than 8K, name and arguments included
+MAX_REQUEST_SIZE = 7680
+KEY_SIZE = 25  # A packed 20 byte digest
+# Batched RPCs in flight at once, so that their datagrams (and replies) don't
+# overflow the receiving socket buffers
+MAX_PENDING_BATCHES = 4
+
 
 # pylint: disable=too-many-instance-attributes
 class Server:
@@ -48,6 +55,7 @@ class Server:
         self.protocol = None
         self.refresh_loop = None
         self.save_state_loop = None
+        self.batch_slots = None
 
         # Health Check parameters
         self.check_interval = check_interval  # Heartbeat interval in seconds
@@ -109,6 +117,7 @@ class Server:
         log.info("Node %i listening on %s:%i",
                  self.node.long_id, interface, port)
         self.transport, self.protocol = await listen
+        self.batch_slots = asyncio.Semaphore(MAX_PENDING_BATCHES)
         # finally, schedule refreshing table
         self.refresh_table()
 
@@ -235,6 +244,109 @@ class Server:
         # return true only if at least one store call succeeded
         return any(await asyncio.gather(*results))
 
+    async def get_many(self, keys):
+        """
+        Get several keys at once.
+
+        Each key is asked to the closest node in the local routing table
+        that hasn't been asked yet, with one FIND_VALUES RPC per node and
+        batch instead of one lookup per key.  Keys that none of the k
+        closest nodes has are then looked up one by one with :meth:`get`.
+
+        Returns:
+            A `list` with the value of each key, or :class:`None` if it
+            wasn't found.
+        """
+        dkeys = [digest(key) for key in keys]
+        results = [self.storage.get(dkey) for dkey in dkeys]
+        candidates = {}
+        for index, dkey in enumerate(dkeys):
+            if results[index] is None:
+                candidates[index] = self.protocol.router.find_neighbors(Node(dkey))
+        missing = []
+        while candidates:
+            groups = {}
+            for index, nearest in list(candidates.items()):
+                if not nearest:
+                    missing.append(index)
+                    del candidates[index]
+                    continue
+                groups.setdefault(nearest[0].id, (nearest[0], []))[1].append(index)
+            calls, batches = [], []
+            for peer, indices in groups.values():
+                for batch in split_batches(indices, [KEY_SIZE] * len(indices)):
+                    calls.append(self._call_batch(self.protocol.call_find_values,
+                                                  peer, [dkeys[i] for i in batch]))
+                    batches.append(batch)
+            for batch, result in zip(batches, await asyncio.gather(*calls)):
+                values = result[1] if result[0] else []
+                for position, index in enumerate(batch):
+                    if position < len(values) and values[position] is not None:
+                        results[index] = values[position]
+                        del candidates[index]
+                    elif not result[0] or position < len(values):
+                        # This node failed or doesn't have it: try the next one
+                        candidates[index].pop(0)
+        if missing:
+            found = await asyncio.gather(*(self.get(keys[i]) for i in missing))
+            for index, value in zip(missing, found):
+                results[index] = value
+        return results
+
+    async def set_many(self, items):
+        """
+        Set several (key, value) pairs at once.
+
+        Each key goes to the k closest nodes in the local routing table,
+        without a crawl per key, and each of those nodes receives its keys
+        in as few STORE_MANY RPCs as fit in a message.  Since the local
+        table may not agree with what a crawl would find, this is meant for
+        values that never change (e.g. content-addressed chunks); use
+        :meth:`set` to overwrite a key.
+
+        Returns:
+            A `list` telling, for each pair, whether at least one node
+            stored it.
+        """
+        items = list(items)
+        for _, value in items:
+            if not check_dht_value_type(value):
+                raise TypeError(
+                    "Value must be of type int, float, bool, str, or bytes"
+                )
+        dkeys = [digest(key) for key, _ in items]
+        groups = {}
+        for index, dkey in enumerate(dkeys):
+            node = Node(dkey)
+            nearest = self.protocol.router.find_neighbors(node)
+            if not nearest:
+                log.warning("There are no known neighbors to set key %s",
+                            dkey.hex())
+                continue
+            # if this node is close too, then store here as well
+            biggest = max([n.distance_to(node) for n in nearest])
+            if self.node.distance_to(node) < biggest:
+                self.storage[dkey] = items[index][1]
+            for peer in nearest:
+                groups.setdefault(peer.id, (peer, []))[1].append(index)
+        calls, batches = [], []
+        for peer, indices in groups.values():
+            sizes = [KEY_SIZE + value_size(items[i][1]) for i in indices]
+            for batch in split_batches(indices, sizes):
+                calls.append(self._call_batch(self.protocol.call_store_many,
+                                              peer, [(dkeys[i], items[i][1]) for i in batch]))
+                batches.append(batch)
+        stored = [False] * len(items)
+        for batch, result in zip(batches, await asyncio.gather(*calls)):
+            if result[0]:
+                for index in batch:
+                    stored[index] = True
+        return stored
+
+    async def _call_batch(self, call, node, payload):
+        async with self.batch_slots:
+            return await call(node, payload)
+
     def save_state(self, fname):
         """
         Save the state of this node (the alpha/ksize/id/immediate neighbors)
@@ -287,6 +399,24 @@ class Server:
                                                frequency)
 
 
+def split_batches(indices, sizes, limit=MAX_REQUEST_SIZE):
+    """
+    Split indices into consecutive batches whose sizes add up to at most
+    limit bytes (an item bigger than limit goes alone).
+    """
+    batches = []
+    batch, total = [], 0
+    for index, size in zip(indices, sizes):
+        if batch and total + size > limit:
+            batches.append(batch)
+            batch, total = [], 0
+        batch.append(index)
+        total += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
 def check_dht_value_type(value):
     """
     Checks to see if the type of the value is a valid type for
@@ -3,17 +3,20 @@ import argparse
 from kademlia.network import Server
 from kademlia.storage import ForgetfulStorage
 import os
-import io
-import socket
-import threading
 import json
 import platform
 import uuid
 import time
 import sys
-import zipfile
-from filesystem import FileSystem,Directory,File
+from filesystem import FileSystem,Directory,File,timestamp,iter_files,normalize_path,split_path
 from distributed_node import DistributedFileSystem
+from data_channel import PassiveDataChannel, ActiveDataChannel
+from session import FTPSession, DeferredReplies
+from metadata_cache import MetadataCache
+from journal import Journal, current_command
+from blobstore import BlobStore
+from locks import plan_locks, S, IX, X
+from archive import collect_entries, stream_archive, available_formats, DEFAULT_COMPRESSION_LEVEL
 
 # Ruta completa del script
 script_path = os.path.abspath(__file__)
@@ -24,25 +27,32 @@ script_dir = os.path.dirname(script_path)
 # Configuración del servidor
 HOST = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1'
 PORT = 21
-FILESYSTEM_JSON = os.path.join(script_dir, "filesystem.json")
+CONTROL_BACKLOG = 1024  # Conexiones de control pendientes de aceptar
+FILESYSTEM_JSON = os.path.join(script_dir, "filesystem.json")  # Formato anterior, solo para migrar
+FILESYSTEM_SNAPSHOT = os.path.join(script_dir, "filesystem.snapshot")
+FILESYSTEM_JOURNAL = os.path.join(script_dir, "filesystem.journal")  # Mutaciones posteriores al snapshot
+BLOBS_DIR = os.path.join(script_dir, "blobs")  # Contenido de los archivos
+SEND_CHUNK_SIZE = 256 * 1024  # Bloque de envío para contenido que no está en disco
+RECV_BUFFER_SIZE = 256 * 1024  # Buffer reutilizado para recibir las subidas
+MUTATING_COMMANDS = ("STOR", "STOU", "APPE", "MKD", "DELE", "RMD", "RNTO", "RNFR")
+# Nivel de compresión de las descargas de directorios (0 = sin comprimir)
+ARCHIVE_COMPRESSION_LEVEL = int(os.environ.get("FTP_ARCHIVE_LEVEL", DEFAULT_COMPRESSION_LEVEL))
 
 class FTPApiServer:
-    def __init__(self, host, port,users):
+    def __init__(self, host, port,users, archive_level=ARCHIVE_COMPRESSION_LEVEL):
         self.host = host
         self.port = port
-        self.data_port=0
-        self.data_type='ASCII'
-        self.restart_point = 0
         self.users=users
-        self.path_to_change=None
-        self.file_system = FileSystem()
-        self.   cwd="/"
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.archive_level = archive_level
+        self.file_system = FileSystem(journal=Journal(FILESYSTEM_JOURNAL))
+        self.blobs = BlobStore(BLOBS_DIR)
+        self.cwd="/"
+        self.server = None  # Servidor asyncio de la conexión de control
         self.dfs = DistributedFileSystem()
-        self.loop = None  # Event loop para asyncio
-        self.thread = None  # Hilo para el event loop
 
         self.node = Server(storage=ForgetfulStorage())
+        self.metadata = MetadataCache(self.file_system, self.node, self.dfs, FILESYSTEM_SNAPSHOT, FILESYSTEM_JSON,
+                                      blobs=self.blobs)
     
     @classmethod
     async def create(cls, host, port, users):
@@ -54,788 +64,853 @@ class FTPApiServer:
             await instance.node.bootstrap([(sys.argv[2], port)])
 
         # Cargar sistema de archivos si existe un JSON guardado
-        try:
-            instance.file_system.load_from_json(FILESYSTEM_JSON)
-            print("[INFO] Sistema de archivos cargado desde JSON.")
-        except:
-            instance.file_system.save_to_json(FILESYSTEM_JSON)
-            print("[INFO] No se encontró un archivo JSON, creando nuevo sistema de archivos.")
+        instance.metadata.load()
+        instance.migrate_inline_content()
+        instance.metadata.start()
 
-        instance.start()
         return instance
     
-    def start_loop(self):
-        """Inicia el event loop en un hilo separado."""
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
-        self.loop.run_forever()
-    
-    def start(self):
-        """Inicia el servidor en un hilo y el event loop en otro."""
-        # Inicia el event loop en un hilo separado
-        self.thread = threading.Thread(target=self.start_loop, daemon=True)
-        self.thread.start()
-
-        # Configura el servidor tradicional
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+    async def start(self):
+        """Inicia el servidor de control sobre asyncio: cada sesión es una corrutina del event loop."""
+        self.server = await asyncio.start_server(
+            self.handle_client,
+            self.host,
+            self.port,
+            backlog=CONTROL_BACKLOG
+        )
         print(f"Servidor FTP iniciado en {self.host}:{self.port}")
 
-        while True:
-            client_socket, client_address = self.server_socket.accept()
-            print(f"Conexión establecida con {client_address}")
-
-            # Ejecuta la corrutina en el event loop del hilo secundario
-            future = asyncio.run_coroutine_threadsafe(
-                self.handle_client(client_socket, client_address),
-                self.loop
-            )
-            # Opcional: Maneja excepciones si es necesario
-            future.add_done_callback(lambda f: f.exception() if f.exception() else None)
-
-    # async def start(self):
-
-    #     # Crea un servidor asíncrono
-    #     self.server = await asyncio.start_server(
-    #         self.handle_client,
-    #         self.host,
-    #         self.port
-    #     )
-    #     print(f"Servidor FTP iniciado en {self.host}:{self.port}")
-
-    #     async with self.server:
-    #         await self.server.serve_forever()
-    #     # self.server_socket.bind((self.host, self.port))
-    #     # self.server_socket.listen(5)
-    #     # print(f"Servidor FTP iniciado en {self.host}:{self.port}")
-
-    #     # while True:
-    #     #     client_socket, client_address = self.server_socket.accept()
-    #     #     print(f"Conexión establecida con {client_address}")
-    #     #     threading.Thread(target=self.handle_client, args=(client_socket,client_address)).start()
-
-    async def handle_client(self, client_socket,client_address):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def send(self, writer, message):
+        """Envía una respuesta por la conexión de control respetando el control de flujo."""
+        writer.write(message)
+        await writer.drain()
+
+    async def handle_client(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        print(f"Conexión establecida con {client_address}")
+        session = FTPSession()
+        try:
+            await self.serve_session(reader, writer, session)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            print(f"Conexión perdida con {client_address}: {e}")
+        finally:
+            session.close_data_channel()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            print("Conexión cerrada")
+
+    async def serve_session(self, reader, writer, session):
+        loop = asyncio.get_running_loop()
+        control = writer
         current_dir = self.cwd
-        client_socket.send(b"220 FTP service ready.\r\n")
+        await self.send(writer, b"220 FTP service ready.\r\n")
         authenticated = False
         username = ''
 
         while True:
-            try:
-                resp= await self.node.get("FilesystemJSON")
-                if resp:
-                    # Leer el primer JSON
-                    with open(FILESYSTEM_JSON, "r") as file1:
-                        data1 = json.load(file1)
-
-                    # Leer el segundo JSON
-                    with open(resp, "r") as file2:
-                        data2 = json.load(file2)
-
-                    # Fusionar (data2 sobrescribe data1 si hay claves repetidas)
-                    data1.update(data2)
-
-                    # Guardar el resultado en archivo1.json
-                    with open(FILESYSTEM_JSON, "w") as file1:
-                        json.dump(data1, file1, indent=4)
-
-                self.file_system.load_from_json(FILESYSTEM_JSON)
-            except Exception as e:
-                print("Error al cargar archivo al principio de bucle")
-
-
-            data = client_socket.recv(1024).decode()
+            data = (await reader.readline()).decode()
             if not data:
                 break
+            if not data.strip():
+                continue
 
+            data_transfer = None
+            writer = control
             print(f"Comando recibido: {data.strip()}")
+            try:
+                await self.metadata.refresh()
+            except Exception as e:
+                # El comando se atiende igual con el árbol local; el delta sigue en cola
+                print(f"Error al actualizar los metadatos: {e}")
             command, *args = data.split()
             command = command.upper()
 
-            if command in ["STOR", "STOU", "MKD", "DELE", "RMD", "RNTO","RNFR"]:
-                
-                if not self.dfs.request_global_lock():
-                    client_socket.sendall(b"550 Conflict: File or directory is in use.\r\n")
-                    continue  # No permitir la operación si el lock ya existe
+            lock_owner = lease = mutations = None
+            if authenticated and command in MUTATING_COMMANDS:
+                # Solo se bloquean las rutas que toca el comando; el resto del árbol sigue disponible
+                plan = self.lock_plan(command, args, current_dir, session)
+                lock_owner = await asyncio.to_thread(self.dfs.acquire_locks, plan)
+                if lock_owner is None:
+                    await self.send(writer, b"550 Conflict: File or directory is in use.\r\n")
+                    continue  # No permitir la operación si otra la bloquea
+                # Los leases se renuevan solo mientras dure este comando
+                lease = asyncio.create_task(self.metadata.keep_lease(lock_owner))
+                # La respuesta final espera a que el comando tenga versión en el clúster
+                writer = DeferredReplies(control)
+                # Las mutaciones de este comando se publican (o se deshacen) sin mezclarse con otras sesiones
+                mutations = self.metadata.begin()
 
-            if command == "USER":
-                username = args[0]
-                if username in self.users:
-                    client_socket.sendall(b'331 User name okay, need password.\r\n')
-                else:
-                    client_socket.sendall(b'530 User incorrect.\r\n')
+            try:
+                if command == "USER":
+                    username = args[0]
+                    if username in self.users:
+                        await self.send(writer, b'331 User name okay, need password.\r\n')
+                    else:
+                        await self.send(writer, b'530 User incorrect.\r\n')
 
 
-            elif command == "PASS":
-                password = args[0]
-                if self.users.get(username) == password:
-                    authenticated = True
-                    client_socket.sendall(b'230 User logged in.\r\n')
-                else:
-                    client_socket.sendall(b'530 Password incorrect in.\r\n')
+                elif command == "PASS":
+                    password = args[0]
+                    if self.users.get(username) == password:
+                        authenticated = True
+                        await self.send(writer, b'230 User logged in.\r\n')
+                    else:
+                        await self.send(writer, b'530 Password incorrect in.\r\n')
 
 
-            elif not authenticated :
-                client_socket.sendall(b'530 Not logged in.\r\n')
+                elif not authenticated :
+                    await self.send(writer, b'530 Not logged in.\r\n')
 
 
-            elif command == "PWD":
-                client_socket.sendall(f'257 "{current_dir}"\r\n'.encode())
+                elif command == "PWD":
+                    await self.send(writer, f'257 "{current_dir}"\r\n'.encode())
 
 
-            elif command == "CWD":
-                if args:
-                    new_dir = args[0]
-                    resolved_path = f"{current_dir}/{new_dir}".replace("//", "/")
-                    if self.file_system.resolve_path(resolved_path):
-                        current_dir = resolved_path
-                        client_socket.sendall(b"250 Directory successfully changed.\r\n")
+                elif command == "CWD":
+                    if args:
+                        new_dir = args[0]
+                        resolved_path = f"{current_dir}/{new_dir}".replace("//", "/")
+                        if self.file_system.resolve_path(resolved_path):
+                            current_dir = resolved_path
+                            await self.send(writer, b"250 Directory successfully changed.\r\n")
+                        else:
+                            await self.send(writer, b"550 Failed to change directory.\r\n")
                     else:
-                        client_socket.sendall(b"550 Failed to change directory.\r\n")
-                else:
-                    client_socket.sendall(b"501 Syntax error in parameters or arguments.\r\n")
+                        await self.send(writer, b"501 Syntax error in parameters or arguments.\r\n")
             
 
-            elif command == "LIST":
-                try:
-                    client_socket.sendall(b'150 Here comes the directory listing\r\n')
-                    if not hasattr(self, "data_socket") or not self.data_socket:
-                        client_socket.sendall(b"425 Can't open data connection.\r\n")
-                        return
+                elif command == "LIST":
+                    try:
+                        await self.send(writer, b'150 Here comes the directory listing\r\n')
+                        if not session.data_socket:
+                            await self.send(writer, b"425 Can't open data connection.\r\n")
+                            continue
                     
-                    data_transfer = None  # Asegurar que la variable existe
-                    data_transfer, _ = self.data_socket.accept()
-
-                    # Obtener la lista de archivos en el directorio actual
-                    directory = self.file_system.resolve_path(current_dir)
-
-                    if directory and isinstance(directory, Directory):
-                        file_details = ['Permissions  Links  Size           Last-Modified  Name']
-
-                        for item in directory.contents.values():
-                            item_data = item.to_dict()
-                            details = {
-                                'mode': item_data["permissions"].ljust(11),
-                                'nlink': str(item_data["nlink"]).ljust(6),
-                                'size': str(item_data["size"]).ljust(5),
-                                'mtime': item_data["mtime"].ljust(12),
-                                'name': item_data["name"]
-                            }
-                            file_details.append('{mode}  {nlink} {size}          {mtime}   {name}'.format(**details))
-
-                        dir_list = '\n'.join(file_details) + '\r\n'
-
-                        # Enviar la lista al cliente FTP
-                        data_transfer.sendall(dir_list.encode())
-                        data_transfer.close()
-                        client_socket.sendall(b'226 Directory send OK\r\n')
-                    else:
-                        if data_transfer:
+                        data_transfer = None  # Asegurar que la variable existe
+                        data_transfer = await session.data_socket.accept()
+
+                        # Obtener la lista de archivos en el directorio actual
+                        directory = self.file_system.resolve_path(current_dir)
+
+                        if directory and isinstance(directory, Directory):
+                            file_details = ['Permissions  Links  Size           Last-Modified  Name']
+
+                            for item in directory.contents.values():
+                                item_data = item.info()  # Solo metadatos: no recorre ni decodifica subdirectorios
+                                details = {
+                                    'mode': item_data["permissions"].ljust(11),
+                                    'nlink': str(item_data["nlink"]).ljust(6),
+                                    'size': str(item_data["size"]).ljust(5),
+                                    'mtime': item_data["mtime"].ljust(12),
+                                    'name': item_data["name"]
+                                }
+                                file_details.append('{mode}  {nlink} {size}          {mtime}   {name}'.format(**details))
+
+                            dir_list = '\n'.join(file_details) + '\r\n'
+
+                            # Enviar la lista al cliente FTP
+                            await loop.sock_sendall(data_transfer, dir_list.encode())
                             data_transfer.close()
-                        client_socket.sendall(b"550 Failed to list directory.\r\n")
+                            await self.send(writer, b'226 Directory send OK\r\n')
+                        else:
+                            if data_transfer:
+                                data_transfer.close()
+                            await self.send(writer, b"550 Failed to list directory.\r\n")
 
-                except OSError as e:
-                    client_socket.sendall(f'550 Failed to list directory: {e}\r\n'.encode())
-                    print(f'Error listing directory: {e}')
-                    if data_transfer:
-                        data_transfer.close()
+                    except OSError as e:
+                        await self.send(writer, f'550 Failed to list directory: {e}\r\n'.encode())
+                        print(f'Error listing directory: {e}')
+                        if data_transfer:
+                            data_transfer.close()
 
             
-            elif command == "RETR":
-                try:
-                    filename = args[0]
-                    resolved_path = f"{current_dir}/{filename}".replace("//", "/")
-                    item = self.file_system.resolve_path(resolved_path)
-
-                    if not item:
-                        client_socket.sendall(b'550 File or directory not found.\r\n')
-                        continue
-
-                    if isinstance(item, File):
-                        # Si es un archivo, se transfiere normalmente
-                        client_socket.sendall(b'150 File status okay, about to open data connection.\r\n')
-                        data_transfer, _ = self.data_socket.accept()
-
-                        file_content = item.read()
-                        if self.data_type == 'Binary':
-                            file_content = file_content.encode()
+                elif command == "RETR":
+                    try:
+                        filename = args[0]
+                        resolved_path = f"{current_dir}/{filename}".replace("//", "/")
+                        item = self.file_system.resolve_path(resolved_path)
+
+                        if not item:
+                            await self.send(writer, b'550 File or directory not found.\r\n')
+                            continue
+
+                        if isinstance(item, File):
+                            start_position = session.restart_point
+                            session.restart_point = 0  # Resetear el punto de reinicio
+                            if start_position > item.size:
+                                await self.send(writer, b'554 Requested action not taken: invalid REST parameter.\r\n')
+                                continue
+
+                            # Si es un archivo, se transfiere normalmente (desde el byte de reinicio)
+                            await self.send(writer, b'150 File status okay, about to open data connection.\r\n')
+                            data_transfer = await session.data_socket.accept()
+
+                            if item.blob:
+                                await self.ensure_blobs(item)
+                                # Envío directo desde el blob en disco (sendfile, sin pasar por memoria)
+                                with self.blobs.open(item.blob) as blob_file:
+                                    await loop.sock_sendfile(data_transfer, blob_file, offset=start_position)
+                            else:
+                                await self.send_inline_content(loop, data_transfer, item.read(), start_position)
 
-                        chunk_size = 1024
-                        start_position = self.restart_point
-                        self.restart_point = 0  # Resetear el punto de reinicio
+                            data_transfer.close()
+                            await self.send(writer, b'226 Transfer complete.\r\n')
 
-                        for i in range(start_position, len(file_content), chunk_size):
-                            data_transfer.sendall(file_content[i:i + chunk_size])
+                        elif isinstance(item, Directory):
+                            session.restart_point = 0  # Los archivos comprimidos no se reanudan
+                            # Si es una carpeta, la comprimimos en un hilo y enviamos el ZIP mientras se genera
+                            await self.send(writer, b'150 Directory transfer starting.\r\n')
+                            data_transfer = await session.data_socket.accept()
 
-                        data_transfer.close()
-                        client_socket.sendall(b'226 Transfer complete.\r\n')
+                            await self.ensure_blobs(item)
+                            entries = collect_entries(item, self.blobs)
+                            await stream_archive(loop, data_transfer, entries, session.archive_format, self.archive_level)
 
-                    elif isinstance(item, Directory):
-                        # Si es una carpeta, la comprimimos en memoria y la enviamos al cliente
-                        client_socket.sendall(b'150 Directory transfer starting.\r\n')
-                        data_transfer, _ = self.data_socket.accept()
+                            data_transfer.close()
+                            await self.send(writer, b'226 Directory transfer complete.\r\n')
 
-                        # Crear un archivo ZIP en memoria
-                        zip_buffer = io.BytesIO()
-                        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                            self.add_directory_to_zip(zip_file, item, "")
+                    except Exception as e:
+                        await self.send(writer, b'550 Failed to retrieve file or directory.\r\n')
+                        print(f'Error retrieving file or directory: {e}')
+                        if data_transfer:
+                            data_transfer.close()
 
-                        zip_buffer.seek(0)  # Volver al inicio del buffer antes de enviarlo
 
-                        # Enviar los datos ZIP en bloques de 1024 bytes
-                        chunk_size = 1024
-                        while True:
-                            chunk = zip_buffer.read(chunk_size)
-                            if not chunk:
-                                break
-                            data_transfer.sendall(chunk)
+                elif command == "STOR":
+                    try:
+                        filename = args[0]
+
+                        if '.' in filename:
+                            # Construir la ruta virtual completa (por ejemplo, "/current_dir/archivo.txt")
+                            resolved_path = f"{current_dir}/{filename}".replace("//", "/")
+
+                            start_position = session.restart_point
+                            session.restart_point = 0
+                            existing = self.file_system.resolve_path(resolved_path) if start_position else None
+                            if start_position and (not isinstance(existing, File) or start_position > existing.size):
+                                await self.send(writer, b'554 Requested action not taken: invalid REST parameter.\r\n')
+
+                            elif start_position:
+                                await self.ensure_blobs(existing)
+                                await self.send(writer, b'150 File status okay; about to open data connection.\r\n')
+                                data_transfer = await session.data_socket.accept()
+
+                                # Reanudar: se conservan los primeros bytes y se escribe a partir del punto de reinicio
+                                with self.open_append_writer(existing, keep=start_position) as blob:
+                                    await self.receive_to_blob(loop, data_transfer, blob)
+                                    data_transfer.close()
+                                    self.commit_file_blob(existing, blob)
+                                    self.file_system.record_update(resolved_path, existing)
+                                await self.send(writer, b'226 Transfer complete.\r\n')
+
+                            else:
+                                await self.send(writer, b'150 File status okay; about to open data connection.\r\n')
+                                data_transfer = await session.data_socket.accept()
+
+                                # Recibir el archivo directamente sobre un blob temporal en disco
+                                with self.blobs.writer() as blob:
+                                    await self.receive_to_blob(loop, data_transfer, blob)
+                                    data_transfer.close()
+
+                                    # Obtener el directorio virtual actual donde se almacenará el archivo
+                                    parent_directory = self.file_system.resolve_path(current_dir)
+                                    if parent_directory is None or not isinstance(parent_directory, Directory):
+                                        await self.send(writer, b'550 Failed to store file.\r\n')
+                                    else:
+                                        # Confirmar el blob y guardar el File en la estructura del directorio virtual
+                                        self.store_uploaded_file(filename, resolved_path, blob)
+                                        await self.send(writer, b'226 Transfer complete.\r\n')
+                        else:
+                            await self.send(writer, b'550 Error: Only files are allowed.\r\n')
+                            # Procesar el comando en el sistema distribuido
+                    except Exception as e:
+                        await self.send(writer, b'550 Failed to store file.\r\n')
+                        print(f'Error storing file: {e}')
+                        if data_transfer:
+                            data_transfer.close()
 
-                        data_transfer.close()
-                        client_socket.sendall(b'226 Directory transfer complete.\r\n')
 
-                except Exception as e:
-                    client_socket.sendall(b'550 Failed to retrieve file or directory.\r\n')
-                    print(f'Error retrieving file or directory: {e}')
-                    if data_transfer:
-                        data_transfer.close()
+                elif command == "QUIT":
+                    await self.send(writer, b"221 Closing connection, goodbye.\r\n")
+                    break
 
 
-            elif command == "STOR":
-                try:
-                    filename = args[0]
+                elif command =="ACCT":
+                    response = '211-Account status.\r\n'
+                    response += f'Name: {username}\r\n'
+                    response += 'Authentication: ' + ('Authenticated' if authenticated else 'Not authenticated') + '\r\n'
+                    response += '211 End of account status.\r\n'
+                    await self.send(writer, response.encode())
 
-                    if '.' in filename:
-                        # Construir la ruta virtual completa (por ejemplo, "/current_dir/archivo.txt")
-                        resolved_path = f"{current_dir}/{filename}".replace("//", "/")
-                        
-                        client_socket.sendall(b'150 File status okay; about to open data connection.\r\n')
-                        data_transfer, _ = self.data_socket.accept()
-
-                        # Recibir el archivo en un buffer de memoria
-                        file_buffer = io.BytesIO()
-                        while True:
-                            up_data = data_transfer.recv(1024)
-                            if not up_data:
-                                break
-                            file_buffer.write(up_data)
-                        data_transfer.close()
 
-                        file_buffer.seek(0)
-                        # Convertir el contenido según el modo de transferencia (ASCII o Binary)
-                        if self.data_type == 'Binary':
-                            content = file_buffer.getvalue()  # se mantiene como bytes
-                        else:
-                            content = file_buffer.getvalue().decode()  # se convierte a texto
-                        
-                        # Obtener el directorio virtual actual donde se almacenará el archivo
-                        parent_directory = self.file_system.resolve_path(current_dir)
-                        if parent_directory is None or not isinstance(parent_directory, Directory):
-                            client_socket.sendall(b'550 Failed to store file.\r\n')
+                elif command == "CDUP":
+                    # Si estamos en la raíz, no se puede subir más arriba
+                    if current_dir == "/":
+                        await self.send(writer, b'550 Already at root directory.\r\n')
+                    else:
+                        # Obtener el nuevo directorio padre
+                        parent_path = "/".join(current_dir.strip("/").split("/")[:-1])
+                        parent_path = "/" if parent_path == "" else parent_path
+
+                        # Verificar si el directorio padre existe en el sistema de archivos virtual
+                        if self.file_system.resolve_path(parent_path):
+                            current_dir = parent_path  # Actualizar la ruta actual
+                            await self.send(writer, b'200 Directory changed to parent directory.\r\n')
                         else:
-                            # Crear el objeto File en memoria
-                            new_file = File(filename, content)
-                            # Guardarlo en la estructura del directorio virtual
-                            parent_directory.contents[filename] = new_file
-                            self.file_system.path_map[resolved_path] = new_file
-                            client_socket.sendall(b'226 Transfer complete.\r\n')
+                            await self.send(writer, b'550 Failed to change directory.\r\n')
+
+
+                elif command =="REIN":
+                    authenticated = False
+                    username = ''
+                    session.reset()
+                    await self.send(writer, b'220 Service ready for new user.\r\n')
+
+
+                elif command =="PORT":
+                    try:
+                        data = args[0].split(',')
+                        host = '.'.join(data[:4])
+                        port = int(data[4]) * 256 + int(data[5])
+                        session.set_data_channel(ActiveDataChannel(host, port))
+                        await self.send(writer, b'200 PORT command successful.\r\n')
+                    except Exception as e:
+                        await self.send(writer, b'425 Can not open data connection.\r\n')
+                        print(f'Error opening data connection: {e}')
+
+
+                elif command =="PASV":
+                    try:
+                        session.set_data_channel(PassiveDataChannel(self.host))
+                        data_port = session.data_socket.port
+                        print(self.host)
+                        host_bytes = self.host.split('.')
+                        port_bytes = [data_port // 256, data_port % 256]
+                        await self.send(writer, f'227 Entering Passive Mode ({host_bytes[0]},{host_bytes[1]},{host_bytes[2]},{host_bytes[3]},{port_bytes[0]},{port_bytes[1]})\r\n'.encode())
+                    except Exception as e:
+                        await self.send(writer, b'425 Can not open data connection\r\n')
+                        print(f'Error entering passive mode: {e}')
+
+
+                elif command =="TYPE":
+                    data_type = args[0]
+                    if data_type == 'A':
+                        session.data_type = 'ASCII'
+                        await self.send(writer, b'200 Type set to ASCII.\r\n')
+                    elif data_type == 'I':
+                        session.data_type = 'Binary'
+                        await self.send(writer, b'200 Type set to Binary.\r\n')
                     else:
-                        client_socket.sendall(b'550 Error: Only files are allowed.\r\n')
-                        # Procesar el comando en el sistema distribuido
-                except Exception as e:
-                    client_socket.sendall(b'550 Failed to store file.\r\n')
-                    print(f'Error storing file: {e}')
-                    if data_transfer:
-                        data_transfer.close()
-
-
-            elif command == "QUIT":
-                client_socket.sendall(b"221 Closing connection, goodbye.\r\n")
-                break
-
-
-            elif command =="ACCT":
-                client_socket.sendall(b'211 Account status.\r\n')
-                response += f'Name: {username}\r\n'
-                if authenticated:
-                    response += f'Password: {self.users[username]}\r\n'
-                else:
-                    response += f'Password: {self.admin[username]}\r\n'
-                response += '211 End of account status.\r\n'
+                        await self.send(writer, b'504 Type not implemented.\r\n')
 
 
-            elif command == "CDUP":
-                # Si estamos en la raíz, no se puede subir más arriba
-                if current_dir == "/":
-                    client_socket.sendall(b'550 Already at root directory.\r\n')
-                else:
-                    # Obtener el nuevo directorio padre
-                    parent_path = "/".join(current_dir.strip("/").split("/")[:-1])
-                    parent_path = "/" if parent_path == "" else parent_path
-
-                    # Verificar si el directorio padre existe en el sistema de archivos virtual
-                    if self.file_system.resolve_path(parent_path):
-                        current_dir = parent_path  # Actualizar la ruta actual
-                        client_socket.sendall(b'200 Directory changed to parent directory.\r\n')
+                elif command =="STRU":
+                    structure_type = args[0]
+                    if structure_type == 'F':
+                        await self.send(writer, b'200 File structure set to file.\r\n')
                     else:
-                        client_socket.sendall(b'550 Failed to change directory.\r\n')
-
-
-            elif command =="REIN":
-                authenticated = False
-                username = ''
-                self.data_type = 'ASCII'
-                self.restart_point = 0
-                client_socket.sendall(b'220 Service ready for new user.\r\n')
-
-
-            elif command =="PORT":
-                try:
-                    data = args[0].split(',')
-                    host = '.'.join(data[:4])
-                    port = int(data[4]) * 256 + int(data[5])
-                    self.data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    self.data_socket.connect((host, port))
-                    client_socket.sendall(b'200 PORT command successful.\r\n')
-                except Exception as e:
-                    client_socket.sendall(b'425 Can not open data connection.\r\n')
-                    print(f'Error opening data connection: {e}')
-
-
-            elif command =="PASV":
-                try:
-                    self.data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    self.data_socket.bind((self.host, 0))
-                    self.data_port = self.data_socket.getsockname()[1]
-                    self.data_socket.listen(1)
-                    print(self.host)
-                    host_bytes = self.host.split('.')
-                    port_bytes = [self.data_port // 256, self.data_port % 256]
-                    client_socket.sendall(f'227 Entering Passive Mode ({host_bytes[0]},{host_bytes[1]},{host_bytes[2]},{host_bytes[3]},{port_bytes[0]},{port_bytes[1]})\r\n'.encode())
-                except Exception as e:
-                    client_socket.sendall(b'425 Can not open data connection\r\n')
-                    print(f'Error entering passive mode: {e}')
-
-
-            elif command =="TYPE":
-                data_type = args[0]
-                if data_type == 'A':
-                    self.data_type = 'ASCII'
-                    client_socket.sendall(b'200 Type set to ASCII.\r\n')
-                elif data_type == 'I':
-                    self.data_type = 'Binary'
-                    client_socket.sendall(b'200 Type set to Binary.\r\n')
-                else:
-                    client_socket.sendall(b'504 Type not implemented.\r\n')
+                        await self.send(writer, b'504 Structure not implemented.\r\n')
 
 
-            elif command =="STRU":
-                structure_type = args[0]
-                if structure_type == 'F':
-                    client_socket.sendall(b'200 File structure set to file.\r\n')
-                else:
-                    client_socket.sendall(b'504 Structure not implemented.\r\n')
-
-
-            elif command =="MODE":
-                mode_type = args[0]
-                if mode_type == 'S':
-                    client_socket.sendall(b'200 Mode set to stream.\r\n')
-                else:
-                    client_socket.sendall(b'504 Mode not implemented.\r\n')
+                elif command =="MODE":
+                    mode_type = args[0]
+                    if mode_type == 'S':
+                        await self.send(writer, b'200 Mode set to stream.\r\n')
+                    else:
+                        await self.send(writer, b'504 Mode not implemented.\r\n')
 
             
-            elif command == "STOU":
-                try:
-                    filename = args[0]
-                    name, ext = filename.rsplit(".", 1)
-
-                    if '.' in filename:
-                        filename = str(name)+ str(uuid.uuid1())
-                        filename+= str(ext)
-                        # Construir la ruta virtual completa (por ejemplo, "/current_dir/archivo.txt")
-                        resolved_path = f"{current_dir}/{filename}".replace("//", "/")
+                elif command == "STOU":
+                    session.restart_point = 0  # Un archivo nuevo no se reanuda
+                    try:
+                        filename = args[0]
+                        name, ext = filename.rsplit(".", 1)
+
+                        if '.' in filename:
+                            filename = str(name)+ str(uuid.uuid1())
+                            filename+= str(ext)
+                            # Construir la ruta virtual completa (por ejemplo, "/current_dir/archivo.txt")
+                            resolved_path = f"{current_dir}/{filename}".replace("//", "/")
                         
-                        client_socket.sendall(b'150 File status okay; about to open data connection.\r\n')
-                        data_transfer, _ = self.data_socket.accept()
-
-                        # Recibir el archivo en un buffer de memoria
-                        file_buffer = io.BytesIO()
-                        while True:
-                            up_data = data_transfer.recv(1024)
-                            if not up_data:
-                                break
-                            file_buffer.write(up_data)
-                        data_transfer.close()
-
-                        file_buffer.seek(0)
-                        # Convertir el contenido según el modo de transferencia (ASCII o Binary)
-                        if self.data_type == 'Binary':
-                            content = file_buffer.getvalue()  # se mantiene como bytes
-                        else:
-                            content = file_buffer.getvalue().decode()  # se convierte a texto
-
-                        # Obtener el directorio virtual actual donde se almacenará el archivo
-                        parent_directory = self.file_system.resolve_path(current_dir)
-                        if parent_directory is None or not isinstance(parent_directory, Directory):
-                            client_socket.sendall(b'550 Failed to store file.\r\n')
+                            await self.send(writer, b'150 File status okay; about to open data connection.\r\n')
+                            data_transfer = await session.data_socket.accept()
+
+                            # Recibir el archivo directamente sobre un blob temporal en disco
+                            with self.blobs.writer() as blob:
+                                await self.receive_to_blob(loop, data_transfer, blob)
+                                data_transfer.close()
+
+                                # Obtener el directorio virtual actual donde se almacenará el archivo
+                                parent_directory = self.file_system.resolve_path(current_dir)
+                                if parent_directory is None or not isinstance(parent_directory, Directory):
+                                    await self.send(writer, b'550 Failed to store file.\r\n')
+                                else:
+                                    # Confirmar el blob y guardar el File en la estructura del directorio virtual
+                                    self.store_uploaded_file(filename, resolved_path, blob)
+                                    await self.send(writer, b'226 Transfer complete.\r\n')
                         else:
-                            # Crear el objeto File en memoria
-                            new_file = File(filename, content)
-                            # Guardarlo en la estructura del directorio virtual
-                            parent_directory.contents[filename] = new_file
-                            self.file_system.path_map[resolved_path] = new_file
-                            client_socket.sendall(b'226 Transfer complete.\r\n')
-                    else:
-                        client_socket.sendall(b'550 Error: Only files are allowed.\r\n')
-                except Exception as e:
-                    client_socket.sendall(b'550 Failed to store file.\r\n')
-                    print(f'Error storing file: {e}')
-                    if data_transfer:
-                        data_transfer.close()
+                            await self.send(writer, b'550 Error: Only files are allowed.\r\n')
+                    except Exception as e:
+                        await self.send(writer, b'550 Failed to store file.\r\n')
+                        print(f'Error storing file: {e}')
+                        if data_transfer:
+                            data_transfer.close()
             
 
-            elif command == "APPE":
-                filename = args[0]
-                resolved_path = f"{current_dir}/{filename}".replace("//", "/")
-
-                try:
-                    client_socket.sendall(b'150 File status okay; about to open data connection.\r\n')
-                    data_transfer, _ = self.data_socket.accept()
-
-                    # Recibir los datos del cliente en memoria
-                    file_buffer = io.BytesIO()
-                    while True:
-                        up_data = data_transfer.recv(1024)
-                        if not up_data:
-                            break
-                        file_buffer.write(up_data)
-                    data_transfer.close()
-
-                    file_buffer.seek(0)
-                    content = file_buffer.getvalue().decode() if self.data_type == "ASCII" else file_buffer.getvalue()
-
-                    # Verificar si el archivo existe en el sistema de archivos virtual
-                    file = self.file_system.resolve_path(resolved_path)
-
-                    if file and isinstance(file, File):
-                        file.append(content)  # Agregar contenido al final del archivo existente
-                    else:
-                        # Si el archivo no existe, crearlo
-                        parent_directory = self.file_system.resolve_path(current_dir)
-                        if parent_directory and isinstance(parent_directory, Directory):
-                            new_file = File(filename, content)
-                            parent_directory.contents[filename] = new_file
-                            self.file_system.path_map[resolved_path] = new_file
-
-                    client_socket.sendall(b'226 Append successful.\r\n')
+                elif command == "APPE":
+                    filename = args[0]
+                    resolved_path = f"{current_dir}/{filename}".replace("//", "/")
 
-                except Exception as e:
-                    client_socket.sendall(b'550 Failed to append file.\r\n')
-                    print(f'Error appending file: {e}')
+                    try:
+                        # Verificar si el archivo existe en el sistema de archivos virtual
+                        file = self.file_system.resolve_path(resolved_path)
+                        if not isinstance(file, File):
+                            file = None
+
+                        # Con REST previo se escribe a partir de ese byte en lugar de al final
+                        start_position = session.restart_point
+                        session.restart_point = 0
+                        if start_position and (file is None or start_position > file.size):
+                            await self.send(writer, b'554 Requested action not taken: invalid REST parameter.\r\n')
+                        else:
+                            if file:
+                                await self.ensure_blobs(file)
+                            await self.send(writer, b'150 File status okay; about to open data connection.\r\n')
+                            data_transfer = await session.data_socket.accept()
+
+                            # Recibir los datos a continuación del contenido actual, en un blob temporal
+                            with self.open_append_writer(file, keep=start_position or None) as blob:
+                                await self.receive_to_blob(loop, data_transfer, blob)
+                                data_transfer.close()
+
+                                if file:
+                                    self.commit_file_blob(file, blob)  # Sustituir el contenido del archivo existente
+                                    self.file_system.record_update(resolved_path, file)
+                                else:
+                                    # Si el archivo no existe, crearlo
+                                    parent_directory = self.file_system.resolve_path(current_dir)
+                                    if parent_directory and isinstance(parent_directory, Directory):
+                                        self.store_uploaded_file(filename, resolved_path, blob)
+
+                            await self.send(writer, b'226 Append successful.\r\n')
+
+                    except Exception as e:
+                        await self.send(writer, b'550 Failed to append file.\r\n')
+                        print(f'Error appending file: {e}')
+                        if data_transfer:
+                            data_transfer.close()
 
 
-            elif command =="ALLO":
-                client_socket.sendall(b'200 Command not needed.\r\n')
+                elif command =="ALLO":
+                    await self.send(writer, b'200 Command not needed.\r\n')
 
 
-            elif command =="REST":
-                try:
-                    byte_offset=args[0]
-                    self.restart_point=byte_offset #!Debo de hacer algun tipo de verificacion??
-                    client_socket.sendall(b"350 Restart marker accepted.\r\n")
-                except:
-                    client_socket.sendall(b"501 Syntax error in parameters.\r\n")
+                elif command =="REST":
+                    try:
+                        byte_offset = int(args[0])
+                        if byte_offset < 0:
+                            raise ValueError(byte_offset)
+                        session.restart_point = byte_offset
+                        await self.send(writer, f"350 Restarting at {byte_offset}. Send STOR or RETR to initiate transfer.\r\n".encode())
+                    except (IndexError, ValueError):
+                        await self.send(writer, b"501 Syntax error in parameters.\r\n")
 
 
-            elif command == "RNFR":
+                elif command == "RNFR":
             
-                filename = args[0]
-                resolved_path = f"{current_dir}/{filename}".replace("//", "/")
+                    filename = args[0]
+                    resolved_path = f"{current_dir}/{filename}".replace("//", "/")
 
-                # Verificar si el archivo o directorio existe en la estructura en memoria
-                item_to_rename = self.file_system.resolve_path(resolved_path)
+                    # Verificar si el archivo o directorio existe en la estructura en memoria
+                    item_to_rename = self.file_system.resolve_path(resolved_path)
 
-                if item_to_rename:
-                    self.path_to_change = resolved_path  # Guardar la ruta a renombrar
-                    client_socket.sendall(b"350 Ready for RNTO.\r\n")
-                else:
-                    client_socket.sendall(b"550 File or directory not found.\r\n")
+                    if item_to_rename:
+                        session.path_to_change = resolved_path  # Guardar la ruta a renombrar
+                        await self.send(writer, b"350 Ready for RNTO.\r\n")
+                    else:
+                        await self.send(writer, b"550 File or directory not found.\r\n")
 
 
-            elif command == "RNTO":
-                if not self.path_to_change:
-                    client_socket.sendall(b"503 RNFR required before RNTO.\r\n")
-                    continue
+                elif command == "RNTO" and not session.path_to_change:
+                    await self.send(writer, b"503 RNFR required before RNTO.\r\n")
 
-                try:
-                    new_name = args[0]
-                    old_path = self.path_to_change
+                elif command == "RNTO":
+                    try:
+                        new_name = args[0]
+                        old_path = session.path_to_change
 
-                    # Calcular el directorio padre a partir de la ruta antigua.
-                    parts = old_path.strip("/").split("/")
-                    if len(parts) == 1:
-                        parent_path = "/"  # Si el elemento está en la raíz
-                    else:
-                        parent_path = "/" + "/".join(parts[:-1])
-                    new_path = f"{parent_path}/{new_name}".replace("//", "/")
-                    
-                    # Obtener el directorio padre en el sistema virtual.
-                    parent_directory = self.file_system.resolve_path(parent_path)
-                    if not parent_directory or not isinstance(parent_directory, Directory):
-                        client_socket.sendall(b"550 Failed to rename: parent directory not found.\r\n")
-                        continue
-
-                    # Extraer el nombre antiguo (última parte del old_path).
-                    old_key = parts[-1]
-
-                    # Verificar que el elemento exista en el directorio padre.
-                    if old_key not in parent_directory.contents:
-                        client_socket.sendall(b"550 File or directory not found in parent's directory.\r\n")
-                        continue
-
-                    # Obtener el objeto a renombrar.
-                    item = parent_directory.contents[old_key]
+                        # Calcular el directorio padre a partir de la ruta antigua.
+                        parts = old_path.strip("/").split("/")
+                        if len(parts) == 1:
+                            parent_path = "/"  # Si el elemento está en la raíz
+                        else:
+                            parent_path = "/" + "/".join(parts[:-1])
+                        new_path = f"{parent_path}/{new_name}".replace("//", "/")
                     
-                    # Eliminar la entrada antigua en el directorio y en el mapa de rutas.
-                    del parent_directory.contents[old_key]
-                    del self.file_system.path_map[old_path]
-
-                    # Actualizar el nombre del objeto.
-                    item.name = new_name
-
-                    # Insertar el objeto con el nuevo nombre y actualizar el mapa.
-                    parent_directory.contents[new_name] = item
-                    self.file_system.path_map[new_path] = item
-
-                    client_socket.sendall(b"250 Requested file action completed.\r\n")
-                    self.path_to_change = None
-                except Exception as e:
-                    client_socket.sendall(b"550 Rename failed.\r\n")
-                    print(f"Error renaming file/directory: {e}")
+                        # Lo que ocupe el destino queda sustituido: su contenido se borra como en DELE
+                        moved = self.file_system.resolve_path(old_path)
+                        replaced = self.file_system.resolve_path(new_path)
+
+                        # Renombrar en el sistema virtual (actualiza el índice de rutas de todo el subárbol)
+                        result = self.file_system.mv(old_path, new_path)
+                        if "renombrado" in result:
+                            if replaced is not None and replaced is not moved:
+                                self.discard_blobs(replaced)
+                            await self.send(writer, b"250 Requested file action completed.\r\n")
+                            session.path_to_change = None
+                        else:
+                            await self.send(writer, b"550 Rename failed.\r\n")
+                            print(f"Error renaming file/directory: {result}")
+                    except Exception as e:
+                        await self.send(writer, b"550 Rename failed.\r\n")
+                        print(f"Error renaming file/directory: {e}")
 
 
-            elif command =="ABOR":
-                if self.data_socket:    
-                    self.data_socket.close()
-                    self.data_socket=None
-                    client_socket.sendall(b"226 Closing data connection. Transfer aborted.\r\n")
-                else:
-                    client_socket.sendall(b"225 No transfer to abort.\r\n")
+                elif command =="ABOR":
+                    if session.data_socket:
+                        session.close_data_channel()
+                        await self.send(writer, b"226 Closing data connection. Transfer aborted.\r\n")
+                    else:
+                        await self.send(writer, b"225 No transfer to abort.\r\n")
                     
             
-            elif command == "DELE":
-                try:
-                    filename = args[0]
-                    # Construir la ruta completa virtual del archivo
-                    resolved_path = f"{current_dir}/{filename}".replace("//", "/")
+                elif command == "DELE":
+                    try:
+                        filename = args[0]
+                        # Construir la ruta completa virtual del archivo
+                        resolved_path = f"{current_dir}/{filename}".replace("//", "/")
                     
-                    # Obtener el objeto a través del sistema virtual
-                    item = self.file_system.resolve_path(resolved_path)
+                        # Obtener el objeto a través del sistema virtual
+                        item = self.file_system.resolve_path(resolved_path)
                     
-                    # Verificar que el objeto existe y es un archivo
-                    if item and isinstance(item, File):
-                        result = self.file_system.rm(resolved_path)
-                        if "exitosamente" in result:
-                            client_socket.sendall(b"250 Requested file action okay, completed.\r\n")
+                        # Verificar que el objeto existe y es un archivo
+                        if item and isinstance(item, File):
+                            result = self.file_system.rm(resolved_path)
+                            if "exitosamente" in result:
+                                self.discard_blobs(item)
+                                await self.send(writer, b"250 Requested file action okay, completed.\r\n")
+                            else:
+                                await self.send(writer, b"550 File not found or permission denied.\r\n")
                         else:
-                            client_socket.sendall(b"550 File not found or permission denied.\r\n")
-                    else:
-                        client_socket.sendall(b"550 File not found or permission denied.\r\n")
-                except Exception as e:
-                    client_socket.sendall(b"501 Syntax error in parameters or arguments.\r\n")
-                    print(f"Error in DELE: {e}")
+                            await self.send(writer, b"550 File not found or permission denied.\r\n")
+                    except Exception as e:
+                        await self.send(writer, b"501 Syntax error in parameters or arguments.\r\n")
+                        print(f"Error in DELE: {e}")
                     
 
-            elif command == "RMD":
-                try:
-                    dir_name = args[0]
-                    # Construir la ruta virtual completa del directorio
-                    resolved_path = f"{current_dir}/{dir_name}".replace("//", "/")
+                elif command == "RMD":
+                    try:
+                        dir_name = args[0]
+                        # Construir la ruta virtual completa del directorio
+                        resolved_path = f"{current_dir}/{dir_name}".replace("//", "/")
                     
-                    # Obtener el objeto desde el sistema virtual
-                    item = self.file_system.resolve_path(resolved_path)
+                        # Obtener el objeto desde el sistema virtual
+                        item = self.file_system.resolve_path(resolved_path)
                     
-                    # Verificar que el objeto existe y es un directorio
-                    if item and isinstance(item, Directory):
-                        result = self.file_system.rm(resolved_path)
-                        if "exitosamente" in result:
-                            client_socket.sendall(b"250 Directory deleted successfully.\r\n")
+                        # Verificar que el objeto existe y es un directorio
+                        if item and isinstance(item, Directory):
+                            result = self.file_system.rm(resolved_path)
+                            if "exitosamente" in result:
+                                self.discard_blobs(item)
+                                await self.send(writer, b"250 Directory deleted successfully.\r\n")
+                            else:
+                                await self.send(writer, b"550 Failed to delete directory.\r\n")
                         else:
-                            client_socket.sendall(b"550 Failed to delete directory.\r\n")
-                    else:
-                        client_socket.sendall(b"550 Directory not found.\r\n")
-                except Exception as e:
-                    client_socket.sendall(b"550 Failed to delete directory.\r\n")
-                    print(f"Error in RMD: {e}")
+                            await self.send(writer, b"550 Directory not found.\r\n")
+                    except Exception as e:
+                        await self.send(writer, b"550 Failed to delete directory.\r\n")
+                        print(f"Error in RMD: {e}")
                     
 
-            elif command == "MKD":
-                try:
-                    dir_name = args[0]
-                    # Construir la ruta virtual completa del nuevo directorio
-                    resolved_path = f"{current_dir}/{dir_name}".replace("//", "/")
+                elif command == "MKD":
+                    try:
+                        dir_name = args[0]
+                        # Construir la ruta virtual completa del nuevo directorio
+                        resolved_path = f"{current_dir}/{dir_name}".replace("//", "/")
                     
-                    result = self.file_system.mkdir(resolved_path)
-                    if "exitosamente" in result:
-                        client_socket.sendall(f'257 "{dir_name}" created.\r\n'.encode('utf-8'))
-                    else:
-                        client_socket.sendall(b"550 Directory creation failed (already exists).\r\n")
-                except Exception as e:
-                    client_socket.sendall(b"501 Syntax error in parameters or arguments.\r\n")
-                    print(f"Error in MKD: {e}")
+                        result = self.file_system.mkdir(resolved_path)
+                        if "exitosamente" in result:
+                            await self.send(writer, f'257 "{dir_name}" created.\r\n'.encode('utf-8'))
+                        else:
+                            await self.send(writer, b"550 Directory creation failed (already exists).\r\n")
+                    except Exception as e:
+                        await self.send(writer, b"501 Syntax error in parameters or arguments.\r\n")
+                        print(f"Error in MKD: {e}")
                     
 
-            elif command == "NLST":
-                try:
-                    client_socket.sendall(b'150 Here comes the directory listing\r\n')
+                elif command == "NLST":
+                    try:
+                        await self.send(writer, b'150 Here comes the directory listing\r\n')
                     
-                    # Determinar el directorio a listar:
-                    # Si se proporciona un argumento, se utiliza; de lo contrario, se usa current_dir.
-                    parts = data.split()
-                    if len(parts) > 1:
-                        extra_dir = parts[1]
-                        # Construir la ruta virtual completa (suponiendo que extra_dir es relativa)
-                        virtual_dir = f"{current_dir}/{extra_dir}".replace("//", "/")
-                    else:
-                        virtual_dir = current_dir
-
-                    # Obtener el objeto directorio desde el sistema virtual
-                    directory_obj = self.file_system.resolve_path(virtual_dir)
-                    if not directory_obj or not isinstance(directory_obj, Directory):
-                        client_socket.sendall(b'550 Directory not found.\r\n')
-                        continue
-
-                    # Obtener la lista de nombres (sin detalles adicionales)
-                    file_list = directory_obj.list_contents()
-                    # Crear una cadena con cada nombre separado por un salto de línea
-                    dir_list = "\n".join(file_list) + "\r\n"
-
-                    # Abrir la conexión de datos para enviar la lista
-                    data_transfer, _ = self.data_socket.accept()
-                    data_transfer.sendall(dir_list.encode())
-                    data_transfer.close()
-
-                    client_socket.sendall(b'226 Directory send OK\r\n')
-
-                except Exception as e:
-                    client_socket.sendall(f'550 Failed to list directory: {e}\r\n'.encode())
-                    print(f'Error listing directory: {e}')
-                    if data_transfer:
+                        # Determinar el directorio a listar:
+                        # Si se proporciona un argumento, se utiliza; de lo contrario, se usa current_dir.
+                        parts = data.split()
+                        if len(parts) > 1:
+                            extra_dir = parts[1]
+                            # Construir la ruta virtual completa (suponiendo que extra_dir es relativa)
+                            virtual_dir = f"{current_dir}/{extra_dir}".replace("//", "/")
+                        else:
+                            virtual_dir = current_dir
+
+                        # Obtener el objeto directorio desde el sistema virtual
+                        directory_obj = self.file_system.resolve_path(virtual_dir)
+                        if not directory_obj or not isinstance(directory_obj, Directory):
+                            await self.send(writer, b'550 Directory not found.\r\n')
+                            continue
+
+                        # Obtener la lista de nombres (sin detalles adicionales)
+                        file_list = directory_obj.list_contents()
+                        # Crear una cadena con cada nombre separado por un salto de línea
+                        dir_list = "\n".join(file_list) + "\r\n"
+
+                        # Abrir la conexión de datos para enviar la lista
+                        data_transfer = await session.data_socket.accept()
+                        await loop.sock_sendall(data_transfer, dir_list.encode())
                         data_transfer.close()
 
+                        await self.send(writer, b'226 Directory send OK\r\n')
 
-            elif command =="SITE":
-                client_socket.sendall(b"503 Command not implemented.")
+                    except Exception as e:
+                        await self.send(writer, f'550 Failed to list directory: {e}\r\n'.encode())
+                        print(f'Error listing directory: {e}')
+                        if data_transfer:
+                            data_transfer.close()
 
 
-            elif command =="SMNT":
-                client_socket.sendall(b"503 Command not implemented.")
+                elif command =="SITE":
+                    if len(args) == 2 and args[0].upper() == "ARCHIVE":
+                        # SITE ARCHIVE <ZIP|TAR|TGZ|TZST>: formato de descarga de directorios
+                        archive_format = args[1].upper()
+                        if archive_format in available_formats():
+                            session.archive_format = archive_format
+                            await self.send(writer, f'200 Directory archive format set to {archive_format}.\r\n'.encode())
+                        else:
+                            await self.send(writer, b'504 Archive format not available.\r\n')
+                    else:
+                        await self.send(writer, b"503 Command not implemented.\r\n")
+
+
+                elif command =="SMNT":
+                    await self.send(writer, b"503 Command not implemented.")
 
 
-            elif command =="SYST":
-                system_name = platform.system()
-                client_socket.sendall(f'215 {system_name} Type: L8\r\n'.encode())
+                elif command =="SYST":
+                    system_name = platform.system()
+                    await self.send(writer, f'215 {system_name} Type: L8\r\n'.encode())
 
 
-            elif command =="STAT":
-                parts = args
+                elif command =="STAT":
+                    parts = args
         
-                # STAT without arguments (server status)
-                if len(parts) == 0:
-                    client_socket.sendall(b"211-FTP Server Status:\r\n")
-                    client_socket.sendall(b"Connected to "+ str(self.host).encode('utf-8') +b"\r\n")
-                    client_socket.sendall(b"Current directory: " + current_dir.encode('utf-8') + b"\r\n")
-                    client_socket.sendall(b"211 End of status.\r\n")
-                else:  # STAT with a file/directory argument
-                    # target = os.path.join(current_dir, parts[0])
-                    # if os.path.exists(target):
-                    #     details = self.get_file_info(target)
-                    #     client_socket.sendall(b"213 " + details.encode('utf-8') + b"\r\n")
-                    # else:
-                    #     client_socket.sendall(b"550 File or directory not found.\r\n")
-                    client_socket.sendall(b"503 Command not implemented.\r\n")
-
-
-            elif command =="HELP":
-                client_socket.sendall(b'214 The following commands are recognized.\r\n')
-                response=""                
-                response+='USER <SP> <nombre-usuario> <CRLF>\r\n'
-                response+='PASS <SP> <contraseña> <CRLF>\r\n'
-                response+='ACCT <SP> <información-cuenta> <CRLF>\r\n'
-                response+='CWD  <SP> <nombre-ruta> <CRLF>\r\n'
-                response+='CDUP <CRLF>\r\n'
-                response+='SMNT <SP> <nombre-ruta> <CRLF>\r\n'
-                response+='QUIT <CRLF>\r\n'
-                response+='REIN <CRLF>\r\n'
-                response+='PORT <SP> <dirIP-puerto> <CRLF>\r\n'
-                response+='PASV <CRLF>\r\n'
-                response+='TYPE <SP> <código-tipo> <CRLF>\r\n'
-                response+='STRU <SP> <código-estructura> <CRLF>\r\n'
-                response+='MODE <SP> <código-modo> <CRLF>\r\n'
-                response+='RETR <SP> <nombre-ruta> <CRLF>\r\n'
-                response+='STOR <SP> <nombre-ruta> <CRLF>\r\n'
-                response+='STOU <CRLF>\r\n'
-                response+='APPE <SP> <nombre-ruta> <CRLF>\r\n'
-                response+='ALLO [<SP> <entero-decimal>] | [<SP> R <SP> <entero-decimal>] <CRLF>\r\n'
-                response+='REST <SP> <marcador> <CRLF>\r\n'
-                response+='RNFR <SP> <nombre-ruta> <CRLF>\r\n'
-                response+='RNTO <SP> <nombre-ruta> <CRLF>\r\n'
-                response+='ABOR <CRLF>\r\n'
-                response+='DELE <SP> <nombre-ruta> <CRLF>\r\n'
-                response+='RMD  <SP> <nombre-ruta> <CRLF>\r\n'
-                response+='MKD  <SP> <nombre-ruta> <CRLF>\r\n'
-                response+='PWD  <CRLF>\r\n'
-                response+='LIST [<SP> <nombre-ruta>] <CRLF>\r\n'
-                response+='NLST [<SP> <nombre-ruta>] <CRLF>\r\n'
-                response+='SITE <SP> <cadena> <CRLF>\r\n'
-                response+='SYST <CRLF>\r\n'
-                response+='STAT [<SP> <nombre-ruta>] <CRLF>\r\n'
-                response+='HELP [<SP> <cadena>] <CRLF>\r\n'
-                response+='NOOP <CRLF>\r\n'
-                client_socket.sendall(response.encode())
-                client_socket.sendall(b'214 Help OK.\r\n')
-
-
-            elif command =="NOOP":
-                client_socket.sendall(b"200 OK.\r\n")
-
-
-            else:
-                client_socket.sendall(b"502 Command not implemented.\r\n")
-                print(f"comando no implementado {command}")
-
-            if command in ["STOR", "STOU", "MKD", "DELE", "RMD", "RNTO","RNFR"]:
-                print("VENGO A REPLICAR")
-                self.file_system.save_to_json(FILESYSTEM_JSON)
-                self.dfs.save_filesystem(self.dfs.load_filesystem())
-                await self.node.set("FilesystemJSON",(self.dfs.load_filesystem()).encode())
-                self.dfs.release_global_lock()
-
-        client_socket.close()
-        print("Conexión cerrada")
-    
-    def add_directory_to_zip(self, zip_file, directory, parent_path):
-        """
-        Agrega el contenido de un directorio virtual a un archivo ZIP en memoria.
+                    # STAT without arguments (server status)
+                    if len(parts) == 0:
+                        await self.send(writer, b"211-FTP Server Status:\r\n")
+                        await self.send(writer, b"Connected to "+ str(self.host).encode('utf-8') +b"\r\n")
+                        await self.send(writer, b"Current directory: " + current_dir.encode('utf-8') + b"\r\n")
+                        await self.send(writer, b"211 End of status.\r\n")
+                    else:  # STAT with a file/directory argument
+                        # target = os.path.join(current_dir, parts[0])
+                        # if os.path.exists(target):
+                        #     details = self.get_file_info(target)
+                        #     await self.send(writer, b"213 " + details.encode('utf-8') + b"\r\n")
+                        # else:
+                        #     await self.send(writer, b"550 File or directory not found.\r\n")
+                        await self.send(writer, b"503 Command not implemented.\r\n")
+
+
+                elif command =="HELP":
+                    await self.send(writer, b'214 The following commands are recognized.\r\n')
+                    response=""                
+                    response+='USER <SP> <nombre-usuario> <CRLF>\r\n'
+                    response+='PASS <SP> <contraseña> <CRLF>\r\n'
+                    response+='ACCT <SP> <información-cuenta> <CRLF>\r\n'
+                    response+='CWD  <SP> <nombre-ruta> <CRLF>\r\n'
+                    response+='CDUP <CRLF>\r\n'
+                    response+='SMNT <SP> <nombre-ruta> <CRLF>\r\n'
+                    response+='QUIT <CRLF>\r\n'
+                    response+='REIN <CRLF>\r\n'
+                    response+='PORT <SP> <dirIP-puerto> <CRLF>\r\n'
+                    response+='PASV <CRLF>\r\n'
+                    response+='TYPE <SP> <código-tipo> <CRLF>\r\n'
+                    response+='STRU <SP> <código-estructura> <CRLF>\r\n'
+                    response+='MODE <SP> <código-modo> <CRLF>\r\n'
+                    response+='RETR <SP> <nombre-ruta> <CRLF>\r\n'
+                    response+='STOR <SP> <nombre-ruta> <CRLF>\r\n'
+                    response+='STOU <CRLF>\r\n'
+                    response+='APPE <SP> <nombre-ruta> <CRLF>\r\n'
+                    response+='ALLO [<SP> <entero-decimal>] | [<SP> R <SP> <entero-decimal>] <CRLF>\r\n'
+                    response+='REST <SP> <marcador> <CRLF>\r\n'
+                    response+='RNFR <SP> <nombre-ruta> <CRLF>\r\n'
+                    response+='RNTO <SP> <nombre-ruta> <CRLF>\r\n'
+                    response+='ABOR <CRLF>\r\n'
+                    response+='DELE <SP> <nombre-ruta> <CRLF>\r\n'
+                    response+='RMD  <SP> <nombre-ruta> <CRLF>\r\n'
+                    response+='MKD  <SP> <nombre-ruta> <CRLF>\r\n'
+                    response+='PWD  <CRLF>\r\n'
+                    response+='LIST [<SP> <nombre-ruta>] <CRLF>\r\n'
+                    response+='NLST [<SP> <nombre-ruta>] <CRLF>\r\n'
+                    response+='SITE <SP> <cadena> <CRLF>\r\n'
+                    response+='SYST <CRLF>\r\n'
+                    response+='STAT [<SP> <nombre-ruta>] <CRLF>\r\n'
+                    response+='HELP [<SP> <cadena>] <CRLF>\r\n'
+                    response+='NOOP <CRLF>\r\n'
+                    await self.send(writer, response.encode())
+                    await self.send(writer, b'214 Help OK.\r\n')
+
+
+                elif command =="NOOP":
+                    await self.send(writer, b"200 OK.\r\n")
 
-        :param zip_file: Objeto ZipFile en el que se añadirá el contenido.
-        :param directory: Objeto Directory del sistema de archivos virtual.
-        :param parent_path: Ruta relativa dentro del ZIP.
-        """
-        for name, item in directory.contents.items():
-            zip_path = f"{parent_path}/{name}".strip("/")  # Ruta dentro del ZIP
 
-            if isinstance(item, File):
-                # Agregar archivos al ZIP con su contenido en memoria
-                zip_file.writestr(zip_path, item.read())
+                else:
+                    await self.send(writer, b"502 Command not implemented.\r\n")
+                    print(f"comando no implementado {command}")
+
+                if lock_owner is not None:
+                    print("VENGO A REPLICAR")
+                    # Solo se publica si el comando terminó sin excepciones
+                    try:
+                        await self.metadata.publish(mutations)
+                    except Exception as e:
+                        print(f"No se pudo publicar el comando {command}: {e}")
+                        if mutations.published:
+                            await writer.flush()  # Ya tiene versión: solo falló la replicación
+                        else:
+                            # Sin versión el comando se deshace (``end``) y el cliente recibe respuesta igual
+                            await writer.abort(b"451 Requested action aborted: local error in processing.\r\n")
+                    else:
+                        await writer.flush()
+            finally:
+                # Los bloqueos se liberan aunque el comando falle o se caiga la conexión
+                if lock_owner is not None:
+                    lease.cancel()
+                    try:
+                        # Con los bloqueos aún retenidos: deshacer lo no publicado no pisa a nadie
+                        await self.metadata.end(mutations)
+                    finally:
+                        await asyncio.to_thread(self.dfs.release_locks, lock_owner)
+    
+    def lock_plan(self, command, args, current_dir, session):
+        """Bloqueos de un comando mutante: X sobre lo que modifica (S para RNFR) e intención sobre sus ancestros."""
+        if command == "STOU":
+            # El nombre único aún no se conoce: basta con impedir que el directorio desaparezca
+            return plan_locks([(current_dir, IX)])
+        if not args:
+            return {}
+        if command == "RNTO":
+            if not session.path_to_change:
+                return {}
+            parent_path, _ = split_path(normalize_path(session.path_to_change))
+            return plan_locks([(session.path_to_change, X), (f"{parent_path}/{args[0]}", X)])
+        mode = S if command == "RNFR" else X
+        return plan_locks([(f"{current_dir}/{args[0]}", mode)])
+
+    async def receive_to_blob(self, loop, data_transfer, blob):
+        """Recibe la conexión de datos hasta su cierre escribiendo en ``blob``, con memoria acotada."""
+        buffer = bytearray(RECV_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while True:
+            received = await loop.sock_recv_into(data_transfer, buffer)
+            if not received:
+                break
+            blob.write(view[:received])
 
-            elif isinstance(item, Directory):
-                # Agregar la carpeta al ZIP (sin contenido, solo para estructurar)
-                zip_file.writestr(zip_path + "/", "")
+    def open_append_writer(self, file, keep=None):
+        """Abre un ``BlobWriter`` que conserva los primeros ``keep`` bytes de ``file`` (todo, por defecto).
 
-                # Llamada recursiva para procesar subdirectorios
-                self.add_directory_to_zip(zip_file, item, zip_path)
+        Sin ``file`` el blob empieza vacío. Con ``keep`` menor que el tamaño se
+        reanuda una subida (REST + STOR/APPE) desde ese byte.
+        """
+        if file is None:
+            return self.blobs.writer()
+        if keep is None:
+            keep = file.size
+        if file.blob:
+            # Blob nuevo: el anterior sigue intacto para quien ya lo tenga replicado
+            return self.blobs.writer(source=file.blob, keep=keep)
+        # Contenido en línea de metadatos antiguos: pasa a vivir en el BlobStore
+        previous = file.read()
+        blob = self.blobs.writer()
+        blob.write((previous.encode() if isinstance(previous, str) else previous)[:keep])
+        return blob
+
+    def commit_file_blob(self, file, blob):
+        """Confirma ``blob`` como el contenido de ``file``."""
+        old_blob = file.blob
+        file.blob = blob.commit()
+        file.content = ""
+        file.size = blob.size
+        file.modified_at = timestamp()
+        command = current_command()
+        if command is not None:
+            command.created.append(file.blob)  # Se borra si el comando no llega a publicarse
+        if old_blob and old_blob != file.blob:
+            self.release_blobs([old_blob])
+
+    def store_uploaded_file(self, filename, resolved_path, blob):
+        """Guarda en ``resolved_path`` el archivo subido, reemplazando el anterior si existía."""
+        new_file = File(filename)
+        self.commit_file_blob(new_file, blob)
+        previous = self.file_system.put(resolved_path, new_file)
+        if previous is not None:
+            self.discard_blobs(previous)
+        return new_file
+
+    async def ensure_blobs(self, item):
+        """Trae de otros nodos los blobs de ``item`` (archivo o directorio) que falten en local.
+
+        Los metadatos replicados solo referencian el contenido; los cuerpos se
+        piden bajo demanda la primera vez que se necesitan.
+        """
+        for file in iter_files(item):
+            if file.blob and not self.blobs.exists(file.blob):
+                if not await asyncio.to_thread(self.dfs.fetch_blob, file.blob):
+                    raise FileNotFoundError(f"Blob {file.blob} no disponible en ningún nodo.")
+
+    def migrate_inline_content(self):
+        """Mueve al BlobStore el contenido en línea de metadatos antiguos para que el snapshot solo lleve metadatos."""
+        migrated = 0
+        for file in iter_files(self.file_system.root):
+            if file.content and not file.blob:
+                content = file.content.encode() if isinstance(file.content, str) else file.content
+                file.blob = self.blobs.put(content)
+                file.content = ""
+                file.size = len(content)
+                migrated += 1
+        if migrated:
+            self.metadata.compact()
+            print(f"[INFO] {migrated} archivos migrados al almacén de contenido.")
+
+    def discard_blobs(self, item):
+        """Borra del BlobStore el contenido de un archivo o de todo un directorio."""
+        self.release_blobs([file.blob for file in iter_files(item) if file.blob])
+
+    def release_blobs(self, keys):
+        """Borra ``keys`` del BlobStore; dentro de un comando, solo cuando este se publique.
+
+        Hasta entonces la versión publicada aún los referencia, y si el comando
+        se deshace vuelven a estar en uso.
+        """
+        command = current_command()
+        if command is not None:
+            command.released.extend(keys)
+            return
+        for key in keys:
+            self.blobs.delete(key)
+
+    async def send_inline_content(self, loop, data_transfer, content, offset=0):
+        """Envía contenido guardado en línea en los metadatos, en bloques grandes y sin copias."""
+        if isinstance(content, str):
+            content = content.encode()
+        view = memoryview(content)
+        for i in range(offset, len(view), SEND_CHUNK_SIZE):
+            await loop.sock_sendall(data_transfer, view[i:i + SEND_CHUNK_SIZE])
 
     def get_file_info(self, path):
     # """Generate file or directory information."""
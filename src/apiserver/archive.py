@@ -0,0 +1,184 @@
+import asyncio
+import gzip
+import io
+import math
+import os
+import tarfile
+import time
+import zipfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from filesystem import Directory, File
+
+try:
+    import zstandard
+except ImportError:  # zstd es opcional
+    zstandard = None
+
+ARCHIVE_WORKERS = 4  # Hilos que comprimen directorios en paralelo
+STREAM_BUFFER_SIZE = 256 * 1024  # Se envía por la conexión de datos en bloques de este tamaño
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# Formatos de descarga de directorios (SITE ARCHIVE <formato>)
+ARCHIVE_FORMATS = ("ZIP", "TAR", "TGZ", "TZST")
+
+# Contenido que ya viene comprimido: se guarda sin volver a comprimir
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".7z", ".aac", ".apk", ".avi", ".bz2", ".docx", ".flac", ".gif", ".gz", ".jar",
+    ".jpeg", ".jpg", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".odt", ".ogg", ".pdf",
+    ".png", ".pptx", ".rar", ".tgz", ".webm", ".webp", ".xlsx", ".xz", ".zip", ".zst",
+}
+ENTROPY_SAMPLE_SIZE = 4096
+ENTROPY_THRESHOLD = 7.5  # bits por byte a partir de los cuales no vale la pena comprimir
+
+# zlib libera el GIL, así que la compresión en hilos corre en paralelo con el event loop
+archive_executor = ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS, thread_name_prefix="archive")
+
+
+class SocketStreamWriter(io.RawIOBase):
+    """Archivo de solo escritura (no posicionable) que vuelca en la conexión de datos.
+
+    Se usa desde un hilo de trabajo: cada bloque se envía con ``sock_sendall``
+    en el event loop y el hilo espera a que termine, lo que limita la memoria
+    al tamaño del buffer y propaga los errores de red al compresor.
+    """
+    def __init__(self, loop, sock, buffer_size=STREAM_BUFFER_SIZE):
+        self.loop = loop
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            chunk = bytes(self.buffer)
+            self.buffer.clear()
+            asyncio.run_coroutine_threadsafe(self.loop.sock_sendall(self.sock, chunk), self.loop).result()
+
+
+def collect_entries(directory, blobs):
+    """Recorre un directorio virtual y devuelve las entradas del archivo comprimido.
+
+    Cada entrada es ``(ruta, origen)`` donde origen es la ruta del blob en disco,
+    el contenido en línea (``bytes``) o ``None`` para una carpeta. Se toma en el
+    hilo del event loop para que el compresor no recorra un árbol que cambia.
+    """
+    entries = []
+    stack = [(directory, "")]
+    while stack:
+        current, parent_path = stack.pop()
+        for name, item in current.peek_contents().items():
+            zip_path = f"{parent_path}/{name}".strip("/")  # Ruta dentro del ZIP
+            if isinstance(item, File):
+                if item.blob:
+                    entries.append((zip_path, blobs.path(item.blob)))
+                else:
+                    content = item.read()
+                    entries.append((zip_path, content.encode() if isinstance(content, str) else content))
+            elif isinstance(item, Directory):
+                entries.append((zip_path, None))
+                stack.append((item, zip_path))
+    return entries
+
+
+def sample_entropy(data):
+    """Entropía de Shannon de ``data`` en bits por byte (0 a 8)."""
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+def is_incompressible(zip_path, source):
+    """Decide si una entrada ya está comprimida, por extensión o por una muestra de su contenido."""
+    if os.path.splitext(zip_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return True
+    if isinstance(source, bytes):
+        sample = source[:ENTROPY_SAMPLE_SIZE]
+    else:
+        with open(source, "rb") as f:
+            sample = f.read(ENTROPY_SAMPLE_SIZE)
+    return sample_entropy(sample) >= ENTROPY_THRESHOLD
+
+
+def write_zip(fileobj, entries, level=DEFAULT_COMPRESSION_LEVEL):
+    """Escribe ``entries`` como ZIP sobre ``fileobj`` (puede no ser posicionable).
+
+    Con ``level`` 0 todo se guarda sin comprimir (ZIP_STORED); si no, cada
+    entrada incompresible se guarda tal cual y el resto se comprime con DEFLATE.
+    """
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for zip_path, source in entries:
+            if source is None:
+                # Agregar la carpeta al ZIP (sin contenido, solo para estructurar)
+                zip_file.writestr(zip_path + "/", "")
+                continue
+            if level == 0 or is_incompressible(zip_path, source):
+                options = {"compress_type": zipfile.ZIP_STORED}
+            else:
+                options = {"compress_type": zipfile.ZIP_DEFLATED, "compresslevel": level}
+            if isinstance(source, bytes):
+                zip_file.writestr(zip_path, source, **options)
+            else:
+                zip_file.write(source, zip_path, **options)
+    fileobj.flush()
+
+
+def write_tar(fileobj, entries):
+    """Escribe ``entries`` como un tar en modo stream sobre ``fileobj``."""
+    now = time.time()
+    with tarfile.open(fileobj=fileobj, mode="w|") as tar:
+        for tar_path, source in entries:
+            info = tarfile.TarInfo(tar_path)
+            info.mtime = now
+            if source is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            elif isinstance(source, bytes):
+                info.size = len(source)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(source))
+            else:
+                with open(source, "rb") as f:
+                    info.size = os.fstat(f.fileno()).st_size
+                    info.mode = 0o644
+                    tar.addfile(info, f)
+
+
+def write_archive(fileobj, entries, archive_format="ZIP", level=DEFAULT_COMPRESSION_LEVEL):
+    """Escribe ``entries`` en el formato pedido por la sesión."""
+    if archive_format == "ZIP":
+        write_zip(fileobj, entries, level)
+    elif archive_format == "TAR":
+        write_tar(fileobj, entries)
+    elif archive_format == "TGZ":
+        with gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=level) as gzip_writer:
+            write_tar(gzip_writer, entries)
+    elif archive_format == "TZST":
+        compressor = zstandard.ZstdCompressor(level=max(level, 1))
+        with compressor.stream_writer(fileobj, closefd=False) as zstd_writer:
+            write_tar(zstd_writer, entries)
+    else:
+        raise ValueError(f"Formato de archivo no soportado: {archive_format}")
+    fileobj.flush()
+
+
+def available_formats():
+    """Formatos de archivo que puede generar este servidor."""
+    return [fmt for fmt in ARCHIVE_FORMATS if fmt != "TZST" or zstandard is not None]
+
+
+async def stream_archive(loop, sock, entries, archive_format="ZIP", level=DEFAULT_COMPRESSION_LEVEL):
+    """Comprime ``entries`` en un hilo de trabajo enviando el archivo a medida que se genera."""
+    await loop.run_in_executor(archive_executor, write_archive,
+                               SocketStreamWriter(loop, sock), entries, archive_format, level)
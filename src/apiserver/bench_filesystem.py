@@ -0,0 +1,138 @@
+"""Benchmarks del árbol de metadatos.
+
+``memory`` compara la memoria por entrada de los nodos actuales
+(``__slots__``, nombres internados, marcas de tiempo enteras) con la
+representación anterior (``__dict__`` por instancia y marcas de tiempo
+``float``), extrapolando a un millón de entradas.
+
+``snapshot`` compara tiempo de guardado, tiempo de carga y tamaño del
+snapshot JSON frente al binario a 10k, 100k y 1M entradas:
+
+    python bench_filesystem.py memory [entradas] [archivos_por_directorio]
+    python bench_filesystem.py snapshot [entradas ...]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from filesystem import File, Directory, FileSystem
+from snapshot import encode_snapshot, write_snapshot, load_snapshot
+
+
+class LegacyFile:
+    """Nodo de archivo tal como era antes de ``__slots__``."""
+    def __init__(self, name, content="", permissions=0o644, blob=None):
+        self.name = name
+        self.content = content
+        self.blob = blob
+        self.created_at = time.time()
+        self.modified_at = time.time()
+        self.permissions = permissions
+        self.nlink = 1
+        self.size = len(content)
+
+
+class LegacyDirectory:
+    """Nodo de directorio tal como era antes de ``__slots__``."""
+    def __init__(self, name, permissions=0o755):
+        self.name = name
+        self.contents = {}
+        self.created_at = time.time()
+        self.permissions = permissions
+        self.size = 0
+        self.nlink = 2
+
+
+def build_tree(file_cls, dir_cls, entries, fanout):
+    """Construye un árbol de ``entries`` nodos con ``fanout`` archivos por directorio."""
+    root = dir_cls("/")
+    directory = root
+    for i in range(entries):
+        if i % (fanout + 1) == 0:
+            directory = dir_cls(f"dir{i}")
+            root.contents[directory.name] = directory
+        else:
+            # Los nombres se repiten entre directorios, como en un árbol real
+            name = f"file{i % fanout}.txt"
+            directory.contents[name] = file_cls(name)
+    return root
+
+
+def measure(file_cls, dir_cls, entries, fanout):
+    """Bytes asignados por el árbol completo, medidos con tracemalloc."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tree = build_tree(file_cls, dir_cls, entries, fanout)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del tree
+    return used
+
+
+def bench_memory(args):
+    entries = int(args[0]) if len(args) > 0 else 200_000
+    fanout = int(args[1]) if len(args) > 1 else 50
+    scale = 1_000_000 / entries
+    print(f"{entries} entradas, {fanout} archivos por directorio")
+    for label, file_cls, dir_cls in (("anterior", LegacyFile, LegacyDirectory), ("slots", File, Directory)):
+        used = measure(file_cls, dir_cls, entries, fanout)
+        print(f"{label:>9}: {used / entries:7.1f} B/entrada, {used * scale / 2**20:8.1f} MiB por millón")
+
+
+def build_file_system(entries, fanout=50, depth=3):
+    """Árbol de ``entries`` nodos con archivos en blobs, repartidos en directorios anidados ``depth`` niveles."""
+    fs = FileSystem()
+    directory = fs.root
+    for i in range(entries):
+        if i % (fanout + 1) == 0:
+            parent = fs.root
+            for level in range(depth - 1):
+                # Directorios intermedios compartidos para dar profundidad al árbol
+                name = f"level{level}_{(i // (fanout + 1)) % (10 ** (level + 1))}"
+                parent = parent.contents.setdefault(name, Directory(name))
+            directory = Directory(f"dir{i}")
+            parent.contents[directory.name] = directory
+        else:
+            file = File(f"file{i % fanout}.bin", blob=uuid.uuid4().hex)
+            file.size = i
+            directory.contents[file.name] = file
+    fs.rebuild_index()
+    return fs
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_snapshot(args):
+    sizes = [int(arg) for arg in args] or [10_000, 100_000, 1_000_000]
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, "filesystem.json")
+        binary_path = os.path.join(tmp, "filesystem.snapshot")
+        print(f"{'entradas':>9} {'formato':>8} {'guardar (s)':>12} {'cargar (s)':>11} {'tamaño (MiB)':>13}")
+        for entries in sizes:
+            fs = build_file_system(entries)
+            _, json_save = timed(fs.save_to_json, json_path)
+            _, json_load = timed(FileSystem().load_from_json, json_path)
+            _, binary_save = timed(lambda: write_snapshot(binary_path, encode_snapshot(fs.root, fs.version)))
+            _, binary_load = timed(load_snapshot, binary_path)
+            for label, save, load, path in (("json", json_save, json_load, json_path),
+                                            ("binario", binary_save, binary_load, binary_path)):
+                print(f"{entries:>9} {label:>8} {save:>12.3f} {load:>11.3f} {os.path.getsize(path) / 2**20:>13.1f}")
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "memory"
+    if command == "snapshot":
+        bench_snapshot(sys.argv[2:])
+    else:
+        bench_memory(sys.argv[2:] if command == "memory" else sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
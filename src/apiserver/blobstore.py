@@ -0,0 +1,114 @@
+import os
+import uuid
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _copy_prefix(src, dst, length):
+    """Copia los primeros ``length`` bytes de ``src`` en ``dst`` (ambos abiertos en binario)."""
+    copied = 0
+    try:
+        while copied < length:
+            n = os.copy_file_range(src.fileno(), dst.fileno(), length - copied)
+            if n == 0:
+                break
+            copied += n
+        return copied
+    except (AttributeError, OSError):
+        # Sin copy_file_range (u otro sistema de archivos): copia por bloques
+        src.seek(copied)
+        dst.seek(copied)
+        while copied < length:
+            chunk = src.read(min(COPY_CHUNK_SIZE, length - copied))
+            if not chunk:
+                break
+            dst.write(chunk)
+            copied += len(chunk)
+        return copied
+
+
+class BlobWriter:
+    """Escritura en streaming de un blob.
+
+    Los datos van a un archivo temporal que solo se publica como ``key`` con
+    ``commit`` (``os.replace``, atómico); si no se confirma, se descarta.
+    Un blob confirmado no se reescribe nunca: otros nodos pueden tener copias
+    con la misma clave, así que los cambios (APPE, REST) van a una clave nueva.
+    """
+    def __init__(self, store, key, source=None, keep=0):
+        self.store = store
+        self.key = key
+        self.tmp_path = store.path(f"{key}.{uuid.uuid4().hex}.tmp")
+        self.file = open(self.tmp_path, "wb")
+        self.size = 0
+        self.committed = False
+        if keep:
+            # Conservar el principio del blob ``source`` (APPE, REST)
+            with store.open(source) as src:
+                self.size = _copy_prefix(src, self.file, keep)
+            self.file.seek(self.size)
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        """Confirma el blob y devuelve su clave."""
+        self.file.close()
+        os.replace(self.tmp_path, self.store.path(self.key))
+        self.committed = True
+        return self.key
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.committed:
+            self.abort()
+
+
+class BlobStore:
+    """Almacén en disco del contenido de los archivos, direccionado por clave.
+
+    Los metadatos (``File``) solo guardan la clave del blob; el contenido vive
+    en ``root`` y se sirve directamente desde disco.
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def open(self, key):
+        """Abre el blob para lectura binaria."""
+        return open(self.path(key), "rb")
+
+    def writer(self, key=None, source=None, keep=0):
+        """Abre un ``BlobWriter`` sobre una clave nueva (o ``key``) que empieza con los primeros ``keep`` bytes de ``source``."""
+        return BlobWriter(self, key or uuid.uuid4().hex, source, keep)
+
+    def put(self, data):
+        """Guarda ``data`` en un blob nuevo y devuelve su clave."""
+        with self.writer() as blob:
+            blob.write(data)
+            return blob.commit()
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
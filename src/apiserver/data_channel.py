@@ -0,0 +1,46 @@
+import asyncio
+import socket
+
+# Segundos que se espera a que se establezca la conexión de datos
+DATA_CONNECTION_TIMEOUT = 30
+
+
+class PassiveDataChannel:
+    """Canal de datos en modo pasivo (PASV): el servidor escucha y el cliente se conecta."""
+    def __init__(self, host):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setblocking(False)
+        self.listener.bind((host, 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+
+    async def accept(self):
+        """Espera la conexión del cliente sin bloquear el event loop."""
+        loop = asyncio.get_running_loop()
+        conn, _ = await asyncio.wait_for(loop.sock_accept(self.listener), DATA_CONNECTION_TIMEOUT)
+        conn.setblocking(False)
+        return conn
+
+    def close(self):
+        self.listener.close()
+
+
+class ActiveDataChannel:
+    """Canal de datos en modo activo (PORT): el servidor se conecta al cliente."""
+    def __init__(self, host, port):
+        self.address = (host, port)
+
+    async def accept(self):
+        """Abre la conexión hacia el cliente sin bloquear el event loop."""
+        loop = asyncio.get_running_loop()
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(conn, self.address), DATA_CONNECTION_TIMEOUT)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def close(self):
+        pass
@@ -3,43 +3,98 @@ import threading
 import json
 import time
 import os
-from collections import defaultdict
+import uuid
+from collections import defaultdict, deque
+from blobstore import BlobStore
+from journal import read_records
+from snapshot import read_header, HEADER
+from locks import LockManager, COMMIT_RESOURCE
+from membership import Membership
+from peer_rpc import PeerPool, SESSION_HELLO, NOTIFICATION_ID, send_frame, recv_frame
+
+BLOB_RECV_BUFFER_SIZE = 256 * 1024
+
+
+def request_once(sock, message):
+    """Envía ``message`` por una conexión de un solo uso y devuelve ``(reader, respuesta)``."""
+    send_frame(sock, message, request_id=1)
+    reader = sock.makefile("rb")
+    return reader, recv_frame(reader)[1]
+
+
+def receive_exact(reader, size, write):
+    """Lee exactamente ``size`` bytes de ``reader`` pasándolos por bloques a ``write``."""
+    remaining = size
+    while remaining:
+        chunk = reader.read1(min(BLOB_RECV_BUFFER_SIZE, remaining))
+        if not chunk:
+            raise ConnectionError("Conexión cerrada antes de recibir todos los datos.")
+        write(chunk)
+        remaining -= len(chunk)
+
 
 class DistributedFileSystem:
     MULTICAST_GROUP = "224.1.1.1"
     MULTICAST_PORT = 5000
     NODE_PORT = 6000
-    LOCK_EXPIRATION_TIME = 300  # Segundos antes de liberar un lock automáticamente
+    GOSSIP_PORT = 5001  # UDP del protocolo de pertenencia (SWIM)
+    ANNOUNCE_INTERVAL = 5  # El multicast solo sirve para que los nodos nuevos se den a conocer
+    LEASE_RENEW_INTERVAL = 1.0  # Cada cuánto renueva sus leases un comando en curso (duran locks.LEASE_DURATION)
+    LEASE_CHECK_INTERVAL = 0.5  # Cada cuánto se liberan los leases vencidos
 
     def __init__(self):
         self.script_dir = os.path.dirname(os.path.abspath(__file__))
-        self.filesystem_path = os.path.join(self.script_dir, "filesystem.json")
-        self.lock_path = os.path.join(self.script_dir, "lock.json")
+        self.filesystem_path = os.path.join(self.script_dir, "filesystem.snapshot")  # Snapshot binario
+        self.journal_path = os.path.join(self.script_dir, "filesystem.journal")  # Deltas posteriores al snapshot
+        self.blobs = BlobStore(os.path.join(self.script_dir, "blobs"))  # Contenido de los archivos
         self.node_start_time = time.time()
-        self.discovered_nodes = set()
-        self.global_lock = self.load_global_lock()
+        self.local_ip = self.get_local_ip()
+        # Nodos vivos según la pertenencia; se sustituye entero (copy-on-write) para poder iterarlo sin lock
+        self.discovered_nodes = frozenset()
+        self.peers = PeerPool()  # Conexiones persistentes para los mensajes de control
+        self.membership = Membership(self.local_ip, self.GOSSIP_PORT, self.NODE_PORT,
+                                     on_join=self.node_joined, on_leave=self.node_left)
+        # Leases jerárquicos por ruta de todo el clúster; el turno de publicación lleva fencing
+        self.locks = LockManager(fenced=(COMMIT_RESOURCE,))
+        self.known_version = 0  # Mayor versión del journal publicada que conoce este nodo
+        self.incoming_deltas = deque()  # (seq, registros) recibidos de otros nodos, los aplica MetadataCache
+        self.on_delta = None  # Aviso (desde el hilo de red) de que llegó un delta a ``incoming_deltas``
 
         # Iniciar servicios en hilos separados
+        self.membership.start()
         threading.Thread(target=self.send_heartbeat, daemon=True).start()
         threading.Thread(target=self.listen_for_heartbeats, daemon=True).start()
         threading.Thread(target=self.start_server, daemon=True).start()
         threading.Thread(target=self.cleanup_expired_locks, daemon=True).start()
-
-        # Sincronizar con el nodo más antiguo
-        self.sync_filesystem_with_oldest()
+        # La puesta al día con los demás nodos la inicia MetadataCache (catch_up)
 
     def get_local_ip(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        return s.getsockname()[0]
+        """IP de este nodo. Se calcula una vez: abre un socket UDP hacia fuera para ver la interfaz de salida."""
+        if getattr(self, "local_ip", None):
+            return self.local_ip
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.connect(("8.8.8.8", 80))
+                return s.getsockname()[0]
+        except OSError:
+            return "127.0.0.1"
+
+    def node_joined(self, ip, port):
+        self.discovered_nodes = self.discovered_nodes | {(ip, port)}
+
+    def node_left(self, ip, port):
+        """Un nodo caído deja de contactarse y se cierra su conexión persistente."""
+        self.discovered_nodes = self.discovered_nodes - {(ip, port)}
+        self.peers.drop((ip, port))
 
     def send_heartbeat(self):
+        """Anuncia el nodo por multicast; de detectar caídas se encarga ``membership``."""
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        message = json.dumps({"ip": self.local_ip, "port": self.NODE_PORT, "gossip_port": self.GOSSIP_PORT}).encode()
         while True:
-            message = json.dumps({"ip": self.get_local_ip(), "port": self.NODE_PORT})
-            sock.sendto(message.encode(), (self.MULTICAST_GROUP, self.MULTICAST_PORT))
-            time.sleep(5)
+            sock.sendto(message, (self.MULTICAST_GROUP, self.MULTICAST_PORT))
+            time.sleep(self.ANNOUNCE_INTERVAL)
 
     def listen_for_heartbeats(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -52,137 +107,204 @@ class DistributedFileSystem:
         while True:
             data, _ = sock.recvfrom(1024)
             node_info = json.loads(data.decode())
-            if node_info["ip"] != self.get_local_ip():
-                self.discovered_nodes.add((node_info["ip"], node_info["port"]))
-                print(f'Se encontró al nodo: {node_info["ip"]}')
-
-    def load_global_lock(self):
-        try:
-            with open(self.lock_path, "r") as f:
-                return json.load(f) or {}
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
-
-    def save_global_lock(self, data, propagate=True):
-        with open(self.lock_path, "w") as f:
-            json.dump(data, f, indent=4)
-        if propagate:
-            self.propagate_global_lock(data)
+            if node_info["ip"] != self.local_ip:
+                self.membership.join(node_info["ip"], node_info.get("gossip_port", self.GOSSIP_PORT), node_info["port"])
 
     def cleanup_expired_locks(self):
         while True:
-            current_time = time.time()
-            if self.global_lock and current_time - self.global_lock.get("timestamp", 0) > self.LOCK_EXPIRATION_TIME:
-                print("Lock global expirado, liberando...")
-                self.global_lock = {}
-                self.save_global_lock(self.global_lock)
-            time.sleep(60)  # Verificar cada minuto
-
-    def request_global_lock(self):
-        responses = self.communicate_with_nodes({"type": "LOCK_REQUEST"})
-        if all(resp.get("status") == "OK" for resp in responses):
-            self.global_lock = {
-                "node": self.get_local_ip(),
-                "timestamp": time.time()
-            }
-            self.save_global_lock(self.global_lock)
-            return True
-        return False
+            expired = self.locks.expire()
+            if expired:
+                print(f"{len(expired)} leases vencidos, liberando...")
+            time.sleep(self.LEASE_CHECK_INTERVAL)
 
-    def release_global_lock(self):
-        if self.global_lock:
-            self.global_lock = {}
-            self.save_global_lock(self.global_lock)
+    def renew_locks(self, owner):
+        """Renueva los leases de ``owner`` aquí y en los demás nodos (lo llama la operación que los retiene)."""
+        self.locks.renew([owner])
+        self.broadcast_message({"type": "LOCK_RENEW", "owners": [owner]})
 
-    def propagate_global_lock(self, data):
-        self.broadcast_message({"type": "LOCK_UPDATE", "lock": data})
+    def acquire_locks(self, plan):
+        """Adquiere ``plan`` (``{ruta: modo}``, ver ``locks.plan_locks``) en este nodo y en los demás.
 
-    def load_filesystem(self):
-        try:
-            with open(self.filesystem_path, "r") as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print("NO DELVOLVI NADAAA")
+        Devuelve el identificador del dueño, que se pasa a ``release_locks``,
+        o None si alguna ruta está en uso por una operación incompatible.
+        """
+        owner = f"{self.local_ip}/{uuid.uuid4().hex}"
+        token = self.locks.next_token()
+        if not self.locks.try_acquire(owner, plan, token):
             return None
+        # Basta una denegación para no esperar al resto de nodos
+        responses = self.communicate_with_nodes({"type": "LOCK_REQUEST", "owner": owner, "locks": plan, "token": token},
+                                                until=lambda resp: resp.get("status") != "OK")
+        for resp in responses:
+            self.known_version = max(self.known_version, resp.get("version", 0))
+            self.locks.observe(resp.get("fence", 0))
+        if all(resp.get("status") == "OK" for resp in responses):
+            return owner
+        self.release_locks(owner)  # También en los nodos que sí lo concedieron
+        return None
 
-    def save_filesystem(self, data, propagate=True):
-        data["last_update"] = time.time()
-        with open(self.filesystem_path, "w") as f:
-            json.dump(data, f, indent=4)
-        if propagate:
-            self.propagate_filesystem()
+    def release_locks(self, owner):
+        self.locks.release(owner)
+        self.broadcast_message({"type": "LOCK_RELEASE", "owner": owner})
 
-    def propagate_filesystem(self):
-        self.broadcast_message({"type": "FILESYSTEM_UPDATE"})
-        for ip, port in self.discovered_nodes:
-            try:
-                with socket.create_connection((ip, port), timeout=5) as sock:
-                    # Enviar el archivo JSON
-                    self.send_json_file(sock, self.filesystem_path)
-            except:
-                pass
-
-    def communicate_with_nodes(self, message):
-        responses = []
-        for ip, port in self.discovered_nodes:
-            try:
-                with socket.create_connection((ip, port), timeout=5) as sock:
-                    sock.sendall(json.dumps(message).encode())
-                    response = json.loads(sock.recv(1024).decode())
-                    responses.append(response)
-            except:
-                pass
-        return responses
+    def propagate_delta(self, seq, records, token):
+        """Replica las mutaciones de la versión ``seq``: solo viajan los registros, no el árbol.
+
+        ``token`` es el del turno de publicación con el que se numeró: los
+        nodos que ya concedieron un turno posterior descartan el delta.
+        """
+        self.known_version = max(self.known_version, seq)
+        self.broadcast_message({"type": "FILESYSTEM_DELTA", "seq": seq, "records": records, "token": token})
+
+    def communicate_with_nodes(self, message, until=None):
+        return self.peers.request_all(list(self.discovered_nodes), message, until=until)
 
     def get_oldest_node(self):
         responses = self.communicate_with_nodes({"type": "NODE_START_TIME", "timestamp": self.node_start_time})
-        responses.append({"ip": self.get_local_ip(), "timestamp": self.node_start_time})
+        responses.append({"ip": self.local_ip, "timestamp": self.node_start_time})
         return min(responses, key=lambda x: x["timestamp"])["ip"]
 
-    def sync_filesystem_with_oldest(self):
+    def snapshot_version(self):
+        try:
+            with open(self.filesystem_path, "rb") as f:
+                return read_header(f.read(HEADER.size))[0]
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def catch_up(self, version, target=0):
+        """Trae de otro nodo lo que falta a partir de ``version``, idealmente hasta ``target``.
+
+        Primero pide los deltas (DELTA_REQUEST); si el otro nodo ya los compactó,
+        pide su snapshot (SNAPSHOT_REQUEST), que queda en ``filesystem_path``.
+        Un nodo cuyos deltas no llegan a ``target`` también está atrasado: se
+        prueba con el siguiente y, si ninguno llega, se usa el que más avance.
+        Devuelve ``("deltas", registros)``, ``("snapshot", registros posteriores)``
+        o ``None`` si ningún nodo pudo ayudar.
         """
-        Sincroniza el sistema de archivos con el nodo más antiguo.
+        best = None
+        for ip, port in list(self.discovered_nodes):
+            try:
+                response = self.peers.request((ip, port), {"type": "DELTA_REQUEST", "since": version})
+                if response.get("status") == "OK":
+                    records = response["records"]
+                    if records and (best is None or records[-1]["seq"] > best[1][-1]["seq"]):
+                        best = ("deltas", records)
+                        if records[-1]["seq"] >= target:
+                            return best
+                    continue
+                if response.get("status") != "SNAPSHOT_REQUIRED":
+                    continue
+
+                # El snapshot viaja en crudo por una conexión propia, sin bloquear la persistente
+                with socket.create_connection((ip, port), timeout=5) as sock:
+                    reader, header = request_once(sock, {"type": "SNAPSHOT_REQUEST"})
+                    if header.get("status") != "OK":
+                        continue
+                    tmp_path = f"{self.filesystem_path}.{port}.recv"
+                    with open(tmp_path, "wb") as f:
+                        receive_exact(reader, header["size"], f.write)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, self.filesystem_path)
+                    print(f"[INFO] Snapshot recibido de {ip} (versión {header['version']}).")
+                    # Ya sustituyó al snapshot local: hay que aplicarlo aunque no llegue a ``target``
+                    return ("snapshot", header["records"])
+            except Exception as e:
+                print(f"[ERROR] No se pudo sincronizar con {ip}: {e}")
+        return best
+
+    def deltas_since(self, since):
+        """Registros posteriores a ``since`` (del journal y de los deltas aún en cola), o None si ya se compactaron.
+
+        Los deltas en cola cuentan porque ``known_version``, que se anuncia en
+        LOCK_REQUEST, ya los incluye.
         """
-        # Obtener el nodo más antiguo
-        oldest_node_ip = self.get_oldest_node()
-        
-        # Si el nodo más antiguo no es el actual, solicitar el sistema de archivos
-        if oldest_node_ip != self.get_local_ip():
+        snapshot_version = self.snapshot_version()
+        if snapshot_version is None or since < snapshot_version:
+            return None
+        records = read_records(self.journal_path, since)[0]
+        last = records[-1]["seq"] if records else since
+        for seq, queued in sorted(tuple(self.incoming_deltas), key=lambda delta: delta[0]):
+            if seq == last + 1:
+                records.extend(queued)
+                last = seq
+        return records
+
+    def send_snapshot(self, sock, request_id):
+        """Responde a SNAPSHOT_REQUEST: cabecera JSON (tamaño, versión, deltas posteriores) y el snapshot en crudo."""
+        with open(self.filesystem_path, "rb") as f:
+            # El descriptor abierto fija esta versión aunque se compacte mientras se envía
+            version = read_header(f.read(HEADER.size))[0]
+            size = os.fstat(f.fileno()).st_size
+            records = read_records(self.journal_path, version)[0]
+            send_frame(sock, {"status": "OK", "size": size, "version": version, "records": records}, request_id)
+            sock.sendfile(f, offset=0)
+
+    def dispatch(self, data):
+        """Atiende un mensaje de control y devuelve la respuesta."""
+        response = {}
+        if data["type"] == "FILESYSTEM_DELTA":
+            if not self.locks.check_fence(COMMIT_RESOURCE, data["token"]):
+                # Su lease venció y otro nodo ya tuvo el turno: la escritura llega tarde
+                print(f"[WARN] Delta {data['seq']} descartado: token {data['token']} vencido.")
+                response = {"status": "FENCED"}
+            else:
+                self.known_version = max(self.known_version, data["seq"])
+                self.incoming_deltas.append((data["seq"], data["records"]))
+                if self.on_delta is not None:
+                    self.on_delta()
+                response = {"status": "QUEUED"}
+        elif data["type"] == "DELTA_REQUEST":
+            records = self.deltas_since(data["since"])
+            if records is None:
+                # Demasiado atrasado: los deltas ya están compactados en el snapshot
+                response = {"status": "SNAPSHOT_REQUIRED"}
+            else:
+                response = {"status": "OK", "records": records}
+        elif data["type"] == "LOCK_REQUEST":
+            granted = self.locks.try_acquire(data["owner"], data["locks"], data["token"])
+            # La versión permite a quien publica detectar que le falta algún delta
+            response = {"status": "OK" if granted else "DENIED", "version": self.known_version,
+                        "fence": self.locks.fence}
+        elif data["type"] == "LOCK_RENEW":
+            self.locks.renew(data["owners"])
+            response = {"status": "RENEWED"}
+        elif data["type"] == "LOCK_RELEASE":
+            self.locks.release(data["owner"])
+            response = {"status": "RELEASED"}
+        elif data["type"] == "NODE_START_TIME":
+            response = {"ip": self.local_ip, "timestamp": self.node_start_time}
+        return response
+
+    def serve_session(self, client_socket, reader):
+        """Atiende una conexión persistente de otro nodo: marcos en orden, respuestas con el id de la petición."""
+        while True:
             try:
-                # Conectar al nodo más antiguo
-                with socket.create_connection((oldest_node_ip, self.NODE_PORT), timeout=5) as sock:
-                    # Enviar solicitud de sistema de archivos
-                    sock.sendall(json.dumps({"type": "FILESYSTEM_REQUEST"}).encode())
-                    
-                    # Recibir el archivo JSON del sistema de archivos
-                    self.receive_json_file(sock, self.filesystem_path)
-                    
-                    # Cargar el sistema de archivos recibido
-                    self.file_system.load_from_json(self.filesystem_path)
-                    print("[INFO] Sistema de archivos sincronizado con el nodo más antiguo.")
+                request_id, data = recv_frame(reader)
+            except (OSError, ValueError):
+                return
+            try:
+                response = self.dispatch(data)
             except Exception as e:
-                print(f"[ERROR] No se pudo sincronizar con el nodo más antiguo: {e}")
+                response = {"status": "ERROR", "error": str(e)}
+            if request_id != NOTIFICATION_ID:
+                send_frame(client_socket, response, request_id)
 
     def handle_request(self, client_socket):
         try:
-            data = json.loads(client_socket.recv(1024).decode())
-            response = {}
-            if data["type"] == "FILESYSTEM_UPDATE":
-                self.receive_json_file(client_socket, self.filesystem_path)
-                response = {"status": "UPDATED"}
-            elif data["type"] == "LOCK_REQUEST":
-                response = {"status": "OK"} if not self.global_lock else {"status": "DENIED"}
-            elif data["type"] == "LOCK_UPDATE":
-                self.global_lock = data["lock"]
-                self.save_global_lock(self.global_lock, propagate=False)
-                response = {"status": "LOCKS_UPDATED"}
-            elif data["type"] == "NODE_START_TIME":
-                response = {"ip": self.get_local_ip(), "timestamp": self.node_start_time}
-            elif data["type"] == "FILESYSTEM_REQUEST":
-                # Enviar el archivo JSON del sistema de archivos
-                self.send_json_file(client_socket, self.filesystem_path)
-                response = {"status": "UPDATED"}
-            client_socket.sendall(json.dumps(response).encode())
+            reader = client_socket.makefile("rb")
+            request_id, data = recv_frame(reader)
+            if data["type"] == SESSION_HELLO["type"]:
+                self.serve_session(client_socket, reader)
+            elif data["type"] == "SNAPSHOT_REQUEST":
+                self.send_snapshot(client_socket, request_id)
+            elif data["type"] == "BLOB_REQUEST":
+                # El contenido no viaja con los metadatos: se sirve bajo demanda
+                self.send_blob(client_socket, data["key"], request_id)
+            elif request_id != NOTIFICATION_ID:
+                send_frame(client_socket, self.dispatch(data), request_id)
+            else:
+                self.dispatch(data)
         except:
             pass
         finally:
@@ -197,48 +319,36 @@ class DistributedFileSystem:
             threading.Thread(target=self.handle_request, args=(client,)).start()
 
     def broadcast_message(self, message):
-        for ip, port in self.discovered_nodes:
+        self.peers.notify_all(list(self.discovered_nodes), message)
+
+    def send_blob(self, sock, key, request_id):
+        """Responde a BLOB_REQUEST: cabecera JSON con el tamaño y luego el blob en crudo."""
+        if not self.blobs.exists(key):
+            send_frame(sock, {"status": "NOT_FOUND"}, request_id)
+            return
+        with self.blobs.open(key) as f:
+            size = os.fstat(f.fileno()).st_size
+            send_frame(sock, {"status": "OK", "size": size}, request_id)
+            sock.sendfile(f)
+
+    def fetch_blob(self, key):
+        """Trae de otro nodo el blob ``key`` al BlobStore local. Devuelve True si lo consiguió."""
+        if self.blobs.exists(key):
+            return True
+        for ip, port in list(self.discovered_nodes):
             try:
                 with socket.create_connection((ip, port), timeout=5) as sock:
-                    sock.sendall(json.dumps(message).encode())
-            except:
-                pass
-
-    def send_json_file(sock, file_path):
-        # Leer el archivo JSON
-        with open(file_path, "rb") as f:
-            file_data = f.read()
-
-        # Enviar el tamaño del archivo
-        file_size = len(file_data)
-        sock.sendall(str(file_size).encode())
-
-        # Esperar confirmación del receptor
-        confirmation = sock.recv(1024).decode()
-        if confirmation != "READY":
-            raise Exception("El receptor no está listo para recibir el archivo.")
-
-        # Enviar el archivo en fragmentos
-        sock.sendall(file_data)
-
-    def receive_json_file(sock, file_path):
-        # Recibir el tamaño del archivo
-        file_size = int(sock.recv(1024).decode())
-
-        # Confirmar que está listo para recibir el archivo
-        sock.sendall("READY".encode())
-
-        # Recibir el archivo en fragmentos
-        received_data = b""
-        while len(received_data) < file_size:
-            chunk = sock.recv(1024)
-            if not chunk:
-                break
-            received_data += chunk
-
-        # Guardar el archivo recibido
-        with open(file_path, "wb") as f:
-            f.write(received_data)
+                    reader, header = request_once(sock, {"type": "BLOB_REQUEST", "key": key})
+                    if header.get("status") != "OK":
+                        continue
+                    with self.blobs.writer(key) as blob:
+                        receive_exact(reader, header["size"], blob.write)
+                        blob.commit()
+                    return True
+            except Exception as e:
+                print(f"[ERROR] No se pudo obtener el blob {key} de {ip}: {e}")
+        return False
+
 
 # class DistributedFileSystem:
 #     MULTICAST_GROUP = "224.1.1.1"
@@ -1,14 +1,43 @@
+import os
+import sys
 import time
 import json
 import stat
+from collections import OrderedDict
+
+MAX_LOADED_DIRECTORIES = 10000  # Directorios decodificados que se mantienen antes de expulsar los fríos
+
+
+def parse_filemode(mode):
+    """Inverso de ``stat.filemode`` para los bits de permisos ('?rwxr-xr-x' -> 0o755)."""
+    if isinstance(mode, int):
+        return mode
+    permissions = 0
+    for char, bit in zip(mode[-9:], (0o400, 0o200, 0o100, 0o40, 0o20, 0o10, 0o4, 0o2, 0o1)):
+        if char != '-':
+            permissions |= bit
+    return permissions
+
+
+def timestamp():
+    """Marca de tiempo en segundos enteros, la resolución que guardan los nodos."""
+    return int(time.time())
+
 
 class File:
-    """Representa un archivo en el sistema de archivos."""
-    def __init__(self, name, content="",permissions=0o644):
-        self.name = name
+    """Representa un archivo en el sistema de archivos.
+
+    Usa ``__slots__`` (sin ``__dict__`` por instancia), nombres internados y
+    marcas de tiempo enteras para que un árbol con millones de entradas ocupe
+    lo mínimo posible.
+    """
+    __slots__ = ("name", "content", "blob", "created_at", "modified_at", "permissions", "nlink", "size")
+
+    def __init__(self, name, content="",permissions=0o644, blob=None):
+        self.name = sys.intern(name)
         self.content = content
-        self.created_at = time.time()
-        self.modified_at = time.time()
+        self.blob = blob  # Clave del contenido en el BlobStore (None si está en línea)
+        self.created_at = self.modified_at = timestamp()
         self.permissions = permissions
         self.nlink = 1
         self.size = len(content)
@@ -18,20 +47,29 @@ class File:
 
     def write(self, new_content):
         self.content = new_content
-        self.modified_at = time.time()
+        self.modified_at = timestamp()
         self.size = len(new_content)
 
     def append(self, extra_content):
         self.content += extra_content
-        self.modified_at = time.time()
+        self.modified_at = timestamp()
         self.size += len(extra_content)
 
+    def info(self):
+        """Metadatos del archivo para listados (LIST)."""
+        return self.to_dict()
+
     def to_dict(self):
-        """Convierte el archivo en un diccionario para serialización JSON."""
-        return {
+        """Convierte el archivo en un diccionario para serialización JSON.
+
+        Solo metadatos: el contenido vive en el BlobStore y se referencia por
+        ``blob``. El contenido en línea solo se conserva para archivos antiguos
+        que aún no se migraron a un blob.
+        """
+        data = {
             "type": "file",
             "name": self.name,
-            "content": self.content,
+            "blob": self.blob,
             "created_at": self.created_at,
             "modified_at": self.modified_at,
             "permissions": stat.filemode(self.permissions),
@@ -39,34 +77,75 @@ class File:
             "size": self.size,
             "mtime": time.strftime('%b %d %H:%M', time.gmtime(self.modified_at))
         }
+        if self.content and not self.blob:
+            data["content"] = self.content
+        return data
 
     @staticmethod
     def from_dict(data):
         """Crea un archivo a partir de un diccionario JSON."""
-        file = File(data["name"], data["content"])
-        file.created_at = data["created_at"]
-        file.modified_at = data["modified_at"]
-        file.permissions = int(data["permissions"], 8)
+        file = File(data["name"], data.get("content", ""), blob=data.get("blob"))
+        file.created_at = int(data["created_at"])
+        file.modified_at = int(data["modified_at"])
+        file.permissions = parse_filemode(data["permissions"])
         file.nlink = data["nlink"]
         file.size = data["size"]
         return file
 
 
 class Directory:
-    """Representa un directorio en el sistema de archivos."""
+    """Representa un directorio en el sistema de archivos.
+
+    Un directorio leído de un snapshot puede estar sin materializar: guarda
+    en ``_source`` dónde está su bloque y solo decodifica sus hijos la
+    primera vez que se accede a ``contents``. Mientras no se modifique
+    (``dirty``) puede volver a ese estado con ``evict``.
+    """
+    __slots__ = ("name", "_contents", "_source", "dirty", "created_at", "permissions", "size", "nlink")
+
     def __init__(self, name,permissions=0o755):
-        self.name = name
-        self.contents = {}  # Diccionario para almacenar archivos y subdirectorios
-        self.created_at = time.time()
+        self.name = sys.intern(name)
+        self._contents = {}  # Diccionario para almacenar archivos y subdirectorios
+        self._source = None  # (decodificador, buffer, desplazamiento) del bloque en el snapshot
+        self.dirty = False
+        self.created_at = timestamp()
         self.permissions = permissions
         self.size=0
         self.nlink = 2 
 
+    @property
+    def contents(self):
+        if self._contents is None:
+            decode, buffer, offset = self._source
+            self._contents = {}
+            decode(buffer, offset, self)
+        return self._contents
+
+    @property
+    def loaded(self):
+        return self._contents is not None
+
+    def peek_contents(self):
+        """Hijos del directorio sin materializarlo: si no está cargado se decodifican aparte."""
+        if self._contents is not None:
+            return self._contents
+        decode, buffer, offset = self._source
+        scratch = Directory(self.name)
+        decode(buffer, offset, scratch)
+        return scratch._contents
+
+    def evict(self):
+        """Descarta los hijos decodificados si el directorio no cambió desde el snapshot."""
+        if self._source is None or self.dirty or self._contents is None:
+            return False
+        self._contents = None
+        return True
+
     def list_contents(self):
         return list(self.contents.keys())
 
-    def to_dict(self):
-        """Convierte el directorio en un diccionario JSON."""
+    def info(self):
+        """Metadatos del directorio sin su contenido (LIST)."""
         return {
             "type": "directory",
             "name": self.name,
@@ -75,69 +154,236 @@ class Directory:
             "permissions": stat.filemode(self.permissions),
             "nlink": self.nlink,
             "mtime": time.strftime('%b %d %H:%M', time.gmtime(self.created_at)),
-            "contents": {name: item.to_dict() for name, item in self.contents.items()}
         }
 
+    def to_dict(self):
+        """Convierte el directorio en un diccionario JSON."""
+        data = self.info()
+        data["contents"] = {name: item.to_dict() for name, item in self.peek_contents().items()}
+        return data
+
     @staticmethod
     def from_dict(data):
         """Crea un directorio a partir de un diccionario JSON."""
         directory = Directory(data["name"])
-        directory.created_at = data["created_at"]
+        directory.created_at = int(data["created_at"])
         directory.nlink = data["nlink"]
-        for name, item in data["contents"].items():
-            if item["type"] == "file":
-                directory.contents[name] = File.from_dict(item)
-            else:
-                directory.contents[name] = Directory.from_dict(item)
+        for item in data["contents"].values():
+            child = node_from_dict(item)
+            directory.contents[child.name] = child  # La clave comparte el nombre internado
         return directory
 
 
+def node_from_dict(data):
+    """Crea un archivo o directorio a partir de su diccionario JSON."""
+    return File.from_dict(data) if data["type"] == "file" else Directory.from_dict(data)
+
+
+def iter_files(item):
+    """Recorre (sin recursión) todos los archivos de ``item`` y sus subdirectorios."""
+    stack = [item]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, File):
+            yield current
+        else:
+            stack.extend(current.peek_contents().values())
+
+
+def normalize_path(path):
+    """Forma canónica de una ruta virtual: '/a/b' (sin barras repetidas ni finales)."""
+    return "/" + "/".join(part for part in path.split("/") if part)
+
+
+def split_path(path):
+    """Divide una ruta normalizada en (ruta del padre, nombre)."""
+    parent_path, name = path.rsplit("/", 1)
+    return parent_path or "/", name
+
+
 class FileSystem:
-    """Sistema de archivos básico en memoria con soporte para exportar e importar JSON."""
-    def __init__(self):
+    """Sistema de archivos básico en memoria con soporte para exportar e importar JSON.
+
+    ``path_map`` indexa por su ruta normalizada cada nodo ya materializado,
+    de modo que ``resolve_path`` es una sola consulta al diccionario a
+    cualquier profundidad; una ruta aún no indexada se recorre desde su
+    ancestro indexado más cercano, decodificando solo esos directorios.
+    Toda mutación pasa por los métodos de esta clase, que mantienen el índice
+    al día para subárboles completos y, si hay un ``journal``, registran la
+    operación en él.
+
+    Los directorios materializados se recuerdan en orden LRU; por encima de
+    ``max_loaded_directories`` los más fríos sin cambios vuelven a quedar
+    solo en el snapshot.
+    """
+    def __init__(self, journal=None, max_loaded_directories=MAX_LOADED_DIRECTORIES):
         self.root = Directory("/")
         self.path_map = {"/": self.root}
+        self.version = 0  # Versión de los metadatos replicados
+        self.journal = journal  # Registro de mutaciones (Journal) opcional
+        self.max_loaded_directories = max_loaded_directories
+        self.loaded_directories = OrderedDict()  # ruta -> Directory, del menos al más reciente
+
+    def _log(self, op, **fields):
+        if self.journal is not None:
+            self.journal.append({"op": op, **fields})
+
+    def _index_subtree(self, path, item):
+        """Agrega ``item`` y sus descendientes ya materializados al índice de rutas."""
+        stack = [(path, item)]
+        while stack:
+            current_path, current = stack.pop()
+            self.path_map[current_path] = current
+            if isinstance(current, Directory) and current.loaded:
+                prefix = current_path.rstrip("/")
+                stack.extend((f"{prefix}/{name}", child) for name, child in current.contents.items())
+
+    def _unindex_subtree(self, path, item):
+        """Quita ``item`` y sus descendientes materializados del índice de rutas."""
+        stack = [(path, item)]
+        while stack:
+            current_path, current = stack.pop()
+            self.path_map.pop(current_path, None)
+            if isinstance(current, Directory):
+                self.loaded_directories.pop(current_path, None)
+                if current.loaded:
+                    stack.extend((f"{current_path}/{name}", child) for name, child in current.contents.items())
+
+    def rebuild_index(self):
+        """Reconstruye el índice de rutas a partir de la parte materializada del árbol."""
+        self.path_map = {}
+        self.loaded_directories.clear()
+        self._index_subtree("/", self.root)
 
     def resolve_path(self, path):
         """Convierte una ruta en un objeto (archivo o directorio)."""
-        path = path.strip("/")
-        if path == "":
-            return self.root
-
-        if path in self.path_map:
-            return self.path_map[path]
-        
-        parts = path.split("/")
-        node = self.root
-
-        for part in parts:
-            if isinstance(node, Directory) and part in node.contents:
-                node = node.contents[part]
-            else:
+        path = normalize_path(path)
+        node = self.path_map.get(path)
+        if node is None:
+            node = self._walk(path)
+        if isinstance(node, Directory):
+            self._touch(path, node)
+        return node
+
+    def _walk(self, path):
+        """Busca ``path`` desde su ancestro indexado más cercano, indexando lo que recorre."""
+        prefix = path
+        while prefix not in self.path_map:
+            prefix = split_path(prefix)[0]
+        node = self.path_map[prefix]
+        current_path = prefix.rstrip("/")
+        for part in path[len(prefix):].strip("/").split("/"):
+            if not isinstance(node, Directory):
                 return None
+            self._touch(current_path or "/", node)
+            node = node.contents.get(part)
+            if node is None:
+                return None
+            current_path = f"{current_path}/{part}"
+            self.path_map[current_path] = node
         return node
 
+    def _touch(self, path, directory):
+        """Marca ``directory`` como usado recientemente y expulsa los directorios fríos si sobran."""
+        self.loaded_directories[path] = directory
+        self.loaded_directories.move_to_end(path)
+        in_use = []  # Ancestros de ``path``: la operación en curso los está recorriendo
+        while len(self.loaded_directories) > self.max_loaded_directories:
+            cold_path, cold = self.loaded_directories.popitem(last=False)
+            if cold_path == path or path.startswith(f"{cold_path}/"):
+                in_use.append((cold_path, cold))
+                continue
+            if (cold is self.root or cold.dirty or cold._source is None
+                    or self.path_map.get(cold_path) is not cold or not cold.loaded):
+                continue
+            for name, child in cold.contents.items():
+                self._unindex_subtree(f"{cold_path}/{name}", child)
+            cold.evict()
+        for cold_path, cold in in_use:
+            self.loaded_directories[cold_path] = cold
+
+    def _mark_dirty(self, path):
+        """Marca el directorio ``path`` y sus ancestros como modificados: ya no se pueden expulsar."""
+        while True:
+            directory = self.path_map.get(path)
+            if directory is not None:
+                directory.dirty = True
+            if path == "/":
+                return
+            path = split_path(path)[0]
+
+    def _parent_of(self, path):
+        """Devuelve (directorio padre, nombre) de una ruta normalizada, o (None, nombre)."""
+        parent_path, name = split_path(path)
+        parent = self.resolve_path(parent_path)
+        return (parent if isinstance(parent, Directory) else None), name
+
+    def _detach(self, path):
+        """Quita del árbol el nodo en ``path`` (sin registrarlo) y lo devuelve, o None."""
+        parent, name = self._parent_of(path)
+        if parent is None or name not in parent.contents:
+            return None
+        item = parent.contents.pop(name)
+        self._unindex_subtree(path, item)
+        self._mark_dirty(split_path(path)[0])
+        return item
+
+    def _place(self, path, item):
+        """Coloca ``item`` en la ruta normalizada ``path`` sin registrar la operación."""
+        parent, name = self._parent_of(path)
+        if parent is None or path == "/":
+            raise FileNotFoundError(path)
+        previous = parent.contents.get(name)
+        if previous is not None:
+            self._unindex_subtree(path, previous)
+        item.name = sys.intern(name)
+        parent.contents[item.name] = item
+        self._index_subtree(path, item)
+        self._mark_dirty(split_path(path)[0])
+        return previous
+
+    def put(self, path, item):
+        """Coloca ``item`` en ``path`` sustituyendo lo que hubiera. Devuelve el elemento anterior."""
+        path = normalize_path(path)
+        previous = self._place(path, item)
+        self._log("put", path=path, node=item.to_dict())
+        return previous
+
+    def record_update(self, path, item):
+        """Registra un nodo modificado en su lugar (APPE, REST) y lo vuelve a colocar en ``path``.
+
+        Colocarlo de nuevo garantiza que el árbol tenga este objeto aunque su
+        directorio se haya expulsado o recargado mientras duraba la transferencia.
+        """
+        path = normalize_path(path)
+        self._place(path, item)
+        self._log("put", path=path, node=item.to_dict())
+
     def mkdir(self, path):
         """Crea un nuevo directorio."""
-        parent_path, dir_name = path.rsplit("/", 1) if "/" in path else ("", path)
-        parent = self.resolve_path(parent_path)
+        path = normalize_path(path)
+        parent, dir_name = self._parent_of(path)
 
-        if parent and isinstance(parent, Directory) and dir_name not in parent.contents:
+        if parent and dir_name not in parent.contents:
             new_dir = Directory(dir_name)
             parent.contents[dir_name] = new_dir
             self.path_map[path] = new_dir
+            self._mark_dirty(path)
+            self._log("mkdir", path=path)
             return f"Directorio '{path}' creado exitosamente."
         return "Error: No se pudo crear el directorio."
 
     def touch(self, path):
         """Crea un archivo vacío."""
-        parent_path, file_name = path.rsplit("/", 1) if "/" in path else ("", path)
-        parent = self.resolve_path(parent_path)
+        path = normalize_path(path)
+        parent, file_name = self._parent_of(path)
 
-        if parent and isinstance(parent, Directory) and file_name not in parent.contents:
+        if parent and file_name not in parent.contents:
             new_file = File(file_name)
             parent.contents[file_name] = new_file
             self.path_map[path] = new_file
+            self._mark_dirty(split_path(path)[0])
+            self._log("put", path=path, node=new_file.to_dict())
             return f"Archivo '{path}' creado exitosamente."
         return "Error: No se pudo crear el archivo."
 
@@ -147,6 +393,7 @@ class FileSystem:
 
         if file and isinstance(file, File):
             file.write(content)
+            self.record_update(path, file)
             return f"Contenido escrito en '{path}'."
         return "Error: Archivo no encontrado."
 
@@ -160,33 +407,32 @@ class FileSystem:
 
     def rm(self, path):
         """Elimina un archivo o directorio."""
-        parent_path, name = path.rsplit("/", 1) if "/" in path else ("", path)
-        parent = self.resolve_path(parent_path)
+        path = normalize_path(path)
 
-        if parent and isinstance(parent, Directory) and name in parent.contents:
-            del parent.contents[name]
-            del self.path_map[path]
+        if self._detach(path) is not None:
+            self._log("rm", path=path)
             return f"'{path}' eliminado exitosamente."
         return "Error: No se pudo eliminar."
 
     def mv(self, old_path, new_path):
         """Mueve o renombra un archivo o directorio."""
+        old_path, new_path = normalize_path(old_path), normalize_path(new_path)
         item = self.resolve_path(old_path)
-        if item is None:
+        if item is None or old_path == "/":
             return "Error: Elemento no encontrado."
+        if new_path == old_path:
+            return f"'{old_path}' renombrado/movido a '{new_path}'."
+        if new_path.startswith(old_path + "/"):
+            return "Error: No se puede mover un directorio dentro de sí mismo."
 
-        parent_path, name = new_path.rsplit("/", 1) if "/" in new_path else ("", new_path)
-        parent = self.resolve_path(parent_path)
-
-        if not parent or not isinstance(parent, Directory):
+        parent, name = self._parent_of(new_path)
+        if parent is None:
             return "Error: No se pudo mover el archivo, el destino no es un directorio válido."
 
-        # Eliminar de la ubicación original
-        self.rm(old_path)
-
-        # Mover el objeto al nuevo directorio
-        parent.contents[name] = item
-        self.path_map[new_path] = item
+        # Eliminar de la ubicación original y colocar en la nueva (actualizando el índice del subárbol)
+        self._detach(old_path)
+        self._place(new_path, item)
+        self._log("mv", path=old_path, to=new_path)
         return f"'{old_path}' renombrado/movido a '{new_path}'."
 
     def ls(self, path="/"):
@@ -197,22 +443,62 @@ class FileSystem:
             return directory.list_contents()
         return "Error: Directorio no encontrado."
 
-    def save_to_json(self, filename):
-        """Guarda el sistema de archivos en un archivo JSON."""
+    def to_dict(self):
+        """Convierte el sistema de archivos completo en un diccionario con su versión."""
         data = self.root.to_dict()  # Convertir sistema de archivos a diccionario
         data["last_update"] = time.time()  # Agregar marca de tiempo
-        with open(filename, "wb") as f:
-            json.dump(data, f, indent=4)
+        data["version"] = self.version
+        return data
+
+    def set_root(self, root, version):
+        """Sustituye el árbol completo (por ejemplo, el leído de un snapshot)."""
+        self.root = root
+        self.rebuild_index()  # Reconstruir el mapa de rutas
+        self.version = version
+
+    def load_from_dict(self, data):
+        """Reconstruye el sistema de archivos a partir de un diccionario."""
+        self.set_root(Directory.from_dict(data), data.get("version", 0))
+
+    def apply(self, record):
+        """Reproduce un registro del journal sobre el árbol (sin volver a registrarlo).
+
+        Devuelve el nodo que el registro quitó o sustituyó, o None.
+        """
+        op, path = record["op"], record["path"]
+        displaced = None
+        if op == "mkdir":
+            parent, name = self._parent_of(path)
+            if parent is not None and name not in parent.contents:
+                parent.contents[name] = new_dir = Directory(name)
+                self.path_map[path] = new_dir
+                self._mark_dirty(path)
+        elif op == "put":
+            displaced = self._place(path, node_from_dict(record["node"]))
+        elif op == "rm":
+            displaced = self._detach(path)
+        elif op == "mv":
+            item = self._detach(path)
+            if item is not None:
+                displaced = self._place(record["to"], item)
+        self.version = max(self.version, record["seq"])
+        return displaced
+
+    def save_to_json(self, filename, data=None):
+        """Guarda el sistema de archivos (o ``data``, ya serializado) en un JSON, sustituyéndolo de forma atómica."""
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(data if data is not None else self.to_dict(), f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
 
     def load_from_json(self, filename):
-        """Carga el sistema de archivos desde un archivo JSON."""
-
         """Carga el sistema de archivos desde un archivo JSON."""
         try:
             with open(filename, "rb") as f:
                 data = json.load(f)
-                self.root = Directory.from_dict(data)  # Asegurar acceso a "root"
-                self.path_map = {"/": self.root}  # Reiniciar mapa de rutas
+                self.load_from_dict(data)
                 print("Sistema de archivos cargado exitosamente.")
         except FileNotFoundError:
             print("Archivo JSON no encontrado, creando sistema de archivos nuevo.")
@@ -6,10 +6,14 @@ from rpcudp.protocol import RPCProtocol
 
 from kademlia.node import Node
 from kademlia.routing import RoutingTable
-from kademlia.utils import digest
+from kademlia.utils import digest, value_size
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+# Replies travel in a single UDP datagram (at most 65507 bytes); a smaller
+# cap keeps several of them from filling the caller's socket buffer
+MAX_RESPONSE_SIZE = 32000
+
 
 class KademliaProtocol(RPCProtocol):
     def __init__(self, source_node, storage, ksize):
@@ -61,6 +65,36 @@ class KademliaProtocol(RPCProtocol):
             return self.rpc_find_node(sender, nodeid, key)
         return {'value': value}
 
+    def rpc_store_many(self, sender, nodeid, items):
+        source = Node(nodeid, sender[0], sender[1])
+        self.welcome_if_new(source)
+        log.debug("got a batched store request from %s for %i keys",
+                  sender, len(items))
+        for key, value in items:
+            self.storage[key] = value
+        return True
+
+    def rpc_find_values(self, sender, nodeid, keys):
+        """
+        Return the values stored here for the given keys, in order, with
+        None for the keys this node doesn't have.
+
+        The reply is cut short once it would exceed MAX_RESPONSE_SIZE
+        bytes, so it may cover only a prefix of the keys; the caller asks
+        again for the rest.
+        """
+        source = Node(nodeid, sender[0], sender[1])
+        self.welcome_if_new(source)
+        values = []
+        size = 0
+        for key in keys:
+            value = self.storage.get(key, None)
+            size += value_size(value)
+            if values and size > MAX_RESPONSE_SIZE:
+                break
+            values.append(value)
+        return values
+
     async def call_find_node(self, node_to_ask, node_to_find):
         address = (node_to_ask.ip, node_to_ask.port)
         result = await self.find_node(address, self.source_node.id,
@@ -83,6 +117,16 @@ class KademliaProtocol(RPCProtocol):
         result = await self.store(address, self.source_node.id, key, value)
         return self.handle_call_response(result, node_to_ask)
 
+    async def call_store_many(self, node_to_ask, items):
+        address = (node_to_ask.ip, node_to_ask.port)
+        result = await self.store_many(address, self.source_node.id, items)
+        return self.handle_call_response(result, node_to_ask)
+
+    async def call_find_values(self, node_to_ask, keys):
+        address = (node_to_ask.ip, node_to_ask.port)
+        result = await self.find_values(address, self.source_node.id, keys)
+        return self.handle_call_response(result, node_to_ask)
+
     def welcome_if_new(self, node):
         """
         Given a new node, send it all the keys/values it should be storing,
@@ -0,0 +1,154 @@
+import threading
+import time
+
+from filesystem import normalize_path
+
+# Modos de bloqueo jerárquico: IS/IX (intención de leer/escribir debajo),
+# S (lectura) y X (escritura exclusiva)
+IS, IX, S, X = "IS", "IX", "S", "X"
+
+COMPATIBLE = {
+    IS: {IS, IX, S},
+    IX: {IS, IX},
+    S: {IS, S},
+    X: set(),
+}
+
+# Recurso (fuera del espacio de rutas) que serializa en todo el clúster la
+# publicación de versiones del journal: los comandos sobre rutas distintas
+# corren a la vez, pero cada uno publica su delta por turno
+COMMIT_RESOURCE = "#commit"
+COMMIT_LOCK = {COMMIT_RESOURCE: X}
+
+LEASE_DURATION = 3.0  # Segundos que dura un lease si su dueño no lo renueva
+
+# Para combinar dos peticiones sobre la misma ruta se toma el modo más fuerte
+STRENGTH = {IS: 0, IX: 1, S: 2, X: 3}
+INTENTION = {S: IS, X: IX, IS: IS, IX: IX}
+
+
+def ancestors(path):
+    """Rutas de los ancestros de ``path`` (normalizada), desde la raíz."""
+    parts = [part for part in path.split("/") if part]
+    return ["/" + "/".join(parts[:i]) for i in range(len(parts))]
+
+
+def plan_locks(targets):
+    """Construye el conjunto de bloqueos ``{ruta: modo}`` para ``targets`` (pares ruta, modo).
+
+    Cada ruta objetivo lleva su modo y cada ancestro el de intención
+    correspondiente, de modo que bloquear ``/a/b`` en X solo choca con
+    operaciones sobre ``/a/b``, sobre lo que hay debajo o sobre un ancestro
+    completo (por ejemplo, ``RMD /a``), y no con escrituras en ``/c``.
+    """
+    plan = {}
+    for path, mode in targets:
+        path = normalize_path(path)
+        for ancestor in ancestors(path):
+            _merge(plan, ancestor, INTENTION[mode])
+        _merge(plan, path, mode)
+    return plan
+
+
+def _merge(plan, path, mode):
+    current = plan.get(path)
+    if current is None or STRENGTH[mode] > STRENGTH[current]:
+        plan[path] = mode
+    elif current == S and mode == IX or current == IX and mode == S:
+        plan[path] = X  # SIX se simplifica a X
+
+
+class LockManager:
+    """Tabla de leases jerárquicos de un nodo, solo en memoria.
+
+    Cada dueño (una operación de algún nodo del clúster) adquiere de una vez
+    todo su plan o nada, como un lease de ``lease_duration`` segundos que
+    debe renovar mientras lo use: si su nodo se cae, el lease vence y las
+    rutas quedan libres en segundos.
+
+    Cada concesión lleva un token de fencing, un reloj de Lamport del
+    clúster: quien pide un lease ya vio todas las concesiones anteriores, así
+    que sobre un mismo recurso los tokens siempre crecen. Para los recursos
+    de ``fenced`` se recuerda el último token concedido, con lo que se
+    rechazan las escrituras de un dueño cuyo lease ya venció.
+    """
+    def __init__(self, lease_duration=LEASE_DURATION, fenced=()):
+        self.lease_duration = lease_duration
+        self.held = {}  # ruta -> {dueño: modo}
+        self.owners = {}  # dueño -> {"locks": plan, "token": ..., "expires": instante monotónico}
+        self.fence = 0  # Mayor token visto
+        self.fenced = set(fenced)
+        self.fences = {}  # recurso de ``fenced`` -> último token concedido
+        self.mutex = threading.Lock()
+
+    def next_token(self):
+        """Token para una nueva petición: mayor que todos los vistos."""
+        with self.mutex:
+            self.fence += 1
+            return self.fence
+
+    def observe(self, token):
+        with self.mutex:
+            self.fence = max(self.fence, token)
+
+    def try_acquire(self, owner, plan, token):
+        """Concede ``plan`` a ``owner`` si es compatible con los leases vigentes de los demás dueños."""
+        with self.mutex:
+            now = time.monotonic()
+            self._expire(now)
+            for path, mode in plan.items():
+                for other, other_mode in self.held.get(path, {}).items():
+                    if other != owner and other_mode not in COMPATIBLE[mode]:
+                        return False
+            for path, mode in plan.items():
+                self.held.setdefault(path, {})[owner] = mode
+                if path in self.fenced:
+                    self.fences[path] = max(self.fences.get(path, 0), token)
+            self.owners[owner] = {"locks": plan, "token": token, "expires": now + self.lease_duration}
+            self.fence = max(self.fence, token)
+            return True
+
+    def renew(self, owners):
+        with self.mutex:
+            expires = time.monotonic() + self.lease_duration
+            for owner in owners:
+                entry = self.owners.get(owner)
+                if entry is not None:
+                    entry["expires"] = expires
+
+    def token(self, owner):
+        with self.mutex:
+            entry = self.owners.get(owner)
+            return entry["token"] if entry is not None else None
+
+    def check_fence(self, resource, token):
+        """Si ``token`` es el último concedido para ``resource`` (o posterior)."""
+        with self.mutex:
+            return token >= self.fences.get(resource, 0)
+
+    def release(self, owner):
+        with self.mutex:
+            return self._release(owner)
+
+    def expire(self):
+        """Libera los leases vencidos (dueños caídos o que dejaron de renovar)."""
+        with self.mutex:
+            return self._expire(time.monotonic())
+
+    def _expire(self, now):
+        expired = [owner for owner, entry in self.owners.items() if entry["expires"] <= now]
+        for owner in expired:
+            self._release(owner)
+        return expired
+
+    def _release(self, owner):
+        entry = self.owners.pop(owner, None)
+        if entry is None:
+            return False
+        for path in entry["locks"]:
+            holders = self.held.get(path)
+            if holders is not None:
+                holders.pop(owner, None)
+                if not holders:
+                    del self.held[path]
+        return True
@@ -0,0 +1,251 @@
+import itertools
+import json
+import random
+import socket
+import threading
+import time
+
+# Pertenencia al clúster al estilo SWIM: cada periodo se sondea a un nodo
+# (ping directo y, si no responde, indirecto a través de otros), los que no
+# responden pasan a sospechosos y, si no lo desmienten a tiempo, a caídos.
+# Los cambios de estado viajan adjuntos a los propios pings (gossip), así que
+# el tráfico por nodo es constante sin importar el tamaño del clúster.
+ALIVE, SUSPECT, DEAD = "alive", "suspect", "dead"
+
+PROTOCOL_PERIOD = 1.0  # Un sondeo por periodo
+ACK_TIMEOUT = 0.3  # Espera del ack directo antes de pedir sondeos indirectos
+INDIRECT_PROBES = 3  # Nodos a los que se pide sondear a un nodo que no responde
+SUSPECT_TIMEOUT = 3.0  # Plazo de un sospechoso para desmentirlo antes de darlo por caído
+DEAD_RETENTION = 60.0  # Los caídos se recuerdan un tiempo para ignorar gossip atrasado
+MAX_PIGGYBACK = 8  # Actualizaciones adjuntas a cada mensaje
+RETRANSMIT_FACTOR = 3  # Cada actualización se reenvía RETRANSMIT_FACTOR * log2(n) veces
+MAX_DATAGRAM = 65507
+
+
+class Member:
+    """Estado de un nodo conocido, identificado por su dirección de gossip (ip, puerto UDP)."""
+    __slots__ = ("address", "node_port", "state", "incarnation", "changed_at")
+
+    def __init__(self, address, node_port, state=ALIVE, incarnation=0):
+        self.address = address
+        self.node_port = node_port
+        self.state = state
+        self.incarnation = incarnation
+        self.changed_at = time.monotonic()
+
+
+class Membership:
+    """Lista de miembros del clúster mantenida por gossip.
+
+    ``on_join(ip, node_port)`` se llama cuando un nodo pasa a estar vivo y
+    ``on_leave(ip, node_port)`` cuando se da por caído, de modo que quien lo
+    usa solo contacta a nodos vivos.
+    """
+    def __init__(self, local_ip, gossip_port, node_port, on_join, on_leave):
+        self.address = (local_ip, gossip_port)
+        self.node_port = node_port
+        self.on_join = on_join
+        self.on_leave = on_leave
+        self.incarnation = 0
+        self.members = {}  # (ip, puerto de gossip) -> Member
+        self.updates = {}  # (ip, puerto) -> [actualización, reenvíos restantes]
+        self.acks = {}  # seq -> threading.Event
+        self.relays = {}  # seq propio -> (quien pidió el sondeo indirecto, su seq)
+        self.seqs = itertools.count(1)
+        self.probe_order = []
+        self.mutex = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("0.0.0.0", gossip_port))
+
+    def start(self):
+        threading.Thread(target=self._receive_loop, daemon=True).start()
+        threading.Thread(target=self._protocol_loop, daemon=True).start()
+
+    def join(self, ip, gossip_port, node_port):
+        """Incorpora un nodo anunciado por multicast (o un nodo semilla) y lo saluda."""
+        address = (ip, gossip_port)
+        if address == self.address:
+            return
+        with self.mutex:
+            member = self.members.get(address)
+            known = member is not None and member.state != DEAD
+        if not known:
+            self._apply({"addr": list(address), "node_port": node_port, "state": ALIVE,
+                         "inc": member.incarnation + 1 if member else 0})
+            self._send(address, {"type": "ping", "seq": next(self.seqs)})
+
+    def alive_members(self):
+        with self.mutex:
+            return [(m.address[0], m.node_port) for m in self.members.values() if m.state != DEAD]
+
+    # --- Mensajes ---
+
+    def _send(self, address, message):
+        message["from"] = list(self.address)
+        message["node_port"] = self.node_port
+        message["inc"] = self.incarnation
+        message["updates"] = self._piggyback()
+        try:
+            self.sock.sendto(json.dumps(message, separators=(",", ":")).encode(), address)
+        except OSError:
+            pass
+
+    def _piggyback(self):
+        """Toma las actualizaciones más recientes, descontando un reenvío a cada una."""
+        with self.mutex:
+            chosen = sorted(self.updates.items(), key=lambda item: -item[1][1])[:MAX_PIGGYBACK]
+            result = []
+            for key, entry in chosen:
+                result.append(entry[0])
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.updates[key]
+            return result
+
+    def _receive_loop(self):
+        while True:
+            try:
+                data, _ = self.sock.recvfrom(MAX_DATAGRAM)
+            except OSError:
+                continue
+            try:
+                self._handle(json.loads(data))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue  # Paquete malformado: se descarta sin detener el hilo
+
+    def _handle(self, message):
+        sender = tuple(message["from"])
+        # Quien envía está vivo, con la encarnación que declara
+        self._apply({"addr": list(sender), "node_port": message["node_port"], "state": ALIVE,
+                     "inc": message["inc"]})
+        for update in message.get("updates", ()):
+            self._apply(update)
+
+        kind = message.get("type")
+        if kind == "ping":
+            self._send(sender, {"type": "ack", "seq": message["seq"]})
+        elif kind == "ping_req":
+            # Sondeo indirecto: se reenvía el ack a quien lo pidió
+            seq = next(self.seqs)
+            with self.mutex:
+                self.relays[seq] = (sender, message["seq"])
+            self._send(tuple(message["target"]), {"type": "ping", "seq": seq})
+        elif kind == "ack":
+            with self.mutex:
+                event = self.acks.pop(message["seq"], None)
+                relay = self.relays.pop(message["seq"], None)
+            if event is not None:
+                event.set()
+            if relay is not None:
+                self._send(relay[0], {"type": "ack", "seq": relay[1]})
+
+    # --- Estados ---
+
+    def _apply(self, update):
+        """Aplica una actualización según las reglas de SWIM (la mayor encarnación manda)."""
+        address = tuple(update["addr"])
+        state, incarnation = update["state"], update["inc"]
+        if address == self.address:
+            if state != ALIVE and incarnation >= self.incarnation:
+                # Desmentir la sospecha con una encarnación nueva
+                self.incarnation = incarnation + 1
+                self._gossip({"addr": list(self.address), "node_port": self.node_port,
+                              "state": ALIVE, "inc": self.incarnation})
+            return
+
+        joined = left = None
+        with self.mutex:
+            member = self.members.get(address)
+            if member is None:
+                if state == DEAD:
+                    return
+                member = self.members[address] = Member(address, update["node_port"], state, incarnation)
+                joined = member
+            elif not self._overrides(member, state, incarnation):
+                return
+            else:
+                was_dead = member.state == DEAD
+                member.state, member.incarnation = state, incarnation
+                member.node_port = update["node_port"]
+                member.changed_at = time.monotonic()
+                if state == DEAD:
+                    left = member
+                elif was_dead:
+                    joined = member
+        self._gossip({"addr": list(address), "node_port": member.node_port, "state": state, "inc": incarnation})
+        if joined is not None:
+            print(f"Se encontró al nodo: {address[0]}")
+            self.on_join(address[0], joined.node_port)
+        if left is not None:
+            print(f"Nodo caído: {address[0]}")
+            self.on_leave(address[0], left.node_port)
+
+    @staticmethod
+    def _overrides(member, state, incarnation):
+        if state == ALIVE:
+            return incarnation > member.incarnation
+        if state == SUSPECT:
+            return (incarnation > member.incarnation or
+                    incarnation == member.incarnation and member.state == ALIVE)
+        return member.state != DEAD and incarnation >= member.incarnation
+
+    def _gossip(self, update):
+        with self.mutex:
+            n = max(len(self.members), 1)
+            retransmits = RETRANSMIT_FACTOR * max(n.bit_length(), 1)
+            self.updates[tuple(update["addr"])] = [update, retransmits]
+
+    # --- Detección de fallos ---
+
+    def _protocol_loop(self):
+        while True:
+            start = time.monotonic()
+            target = self._next_target()
+            if target is not None:
+                self._probe(target)
+            self._expire()
+            time.sleep(max(PROTOCOL_PERIOD - (time.monotonic() - start), 0))
+
+    def _next_target(self):
+        """Recorre los miembros en un orden aleatorio que se rehace en cada vuelta."""
+        with self.mutex:
+            if not self.probe_order:
+                self.probe_order = [m.address for m in self.members.values() if m.state != DEAD]
+                random.shuffle(self.probe_order)
+            while self.probe_order:
+                address = self.probe_order.pop()
+                member = self.members.get(address)
+                if member is not None and member.state != DEAD:
+                    return member
+        return None
+
+    def _probe(self, member):
+        seq = next(self.seqs)
+        event = threading.Event()
+        with self.mutex:
+            self.acks[seq] = event
+        self._send(member.address, {"type": "ping", "seq": seq})
+        if not event.wait(ACK_TIMEOUT):
+            with self.mutex:
+                helpers = [m.address for m in self.members.values()
+                           if m.state == ALIVE and m.address != member.address]
+            for helper in random.sample(helpers, min(INDIRECT_PROBES, len(helpers))):
+                self._send(helper, {"type": "ping_req", "seq": seq, "target": list(member.address)})
+            if not event.wait(PROTOCOL_PERIOD - ACK_TIMEOUT):
+                self._apply({"addr": list(member.address), "node_port": member.node_port,
+                             "state": SUSPECT, "inc": member.incarnation})
+        with self.mutex:
+            self.acks.pop(seq, None)
+
+    def _expire(self):
+        """Da por caídos a los sospechosos que no desmintieron a tiempo y olvida a los caídos antiguos."""
+        now = time.monotonic()
+        with self.mutex:
+            suspects = [m for m in self.members.values()
+                        if m.state == SUSPECT and now - m.changed_at >= SUSPECT_TIMEOUT]
+            for address in [a for a, m in self.members.items()
+                            if m.state == DEAD and now - m.changed_at >= DEAD_RETENTION]:
+                del self.members[address]
+        for member in suspects:
+            self._apply({"addr": list(member.address), "node_port": member.node_port,
+                         "state": DEAD, "inc": member.incarnation})
@@ -0,0 +1,308 @@
+import asyncio
+import os
+import time
+
+from filesystem import FileSystem, iter_files
+from snapshot import encode_snapshot, write_snapshot, load_snapshot
+from locks import COMMIT_LOCK
+
+# Clave de Kademlia con la última versión publicada (el árbol no viaja por la DHT)
+VERSION_KEY = "FilesystemVersion"
+
+class StaleMetadataError(Exception):
+    """No se pudo alcanzar la última versión publicada en el clúster antes de numerar una nueva."""
+
+
+COMPACTION_THRESHOLD = 1000  # Registros del journal tras los que se reescribe el snapshot
+COMMIT_RETRY_MAX_DELAY = 0.5  # Espera máxima entre intentos de obtener el turno de publicación
+
+
+class MetadataCache:
+    """Árbol de metadatos en memoria, replicado entre nodos mediante deltas.
+
+    Las mutaciones locales van al journal del ``FileSystem``: ``publish``
+    añade los registros del comando como una nueva versión y solo esos
+    registros se envían a los demás nodos (``propagate_delta``). Los deltas
+    recibidos se aplican en orden antes del siguiente comando; si falta
+    alguno, se piden al resto de nodos los registros posteriores a la versión
+    local y, si ya se compactaron, su snapshot completo.
+
+    La versión replicada en Kademlia se consulta en segundo plano como mucho
+    una vez cada ``check_interval`` segundos para detectar que se perdieron
+    deltas. Cada ``compaction_threshold`` registros el journal se compacta
+    en el snapshot local, en un hilo; los nodos atrasados piden ese snapshot
+    directamente a otro nodo (SNAPSHOT_REQUIRED).
+
+    El snapshot local usa el formato binario de ``snapshot``; un
+    ``legacy_json_path`` existente solo se lee para migrarlo.
+    """
+    def __init__(self, file_system, node, dfs, snapshot_path, legacy_json_path=None, check_interval=2.0,
+                 compaction_threshold=COMPACTION_THRESHOLD, blobs=None):
+        self.file_system = file_system
+        self.blobs = blobs  # BlobStore del que se borran los blobs al cerrar cada comando
+        self.node = node
+        self.dfs = dfs
+        self.snapshot_path = snapshot_path
+        self.legacy_json_path = legacy_json_path
+        self.check_interval = check_interval
+        self.compaction_threshold = compaction_threshold
+        self._last_remote_check = 0.0
+        self._remote_check = None
+        self._follower = None
+        self._publish_lock = asyncio.Lock()  # El journal se escribe, aplica y compacta en orden
+
+    def load(self):
+        """Carga el snapshot local al arrancar, creándolo si no existe, y reproduce el journal."""
+        if os.path.exists(self.snapshot_path):
+            self.file_system.set_root(*load_snapshot(self.snapshot_path, lazy=True))
+            print("[INFO] Sistema de archivos cargado desde el snapshot.")
+        elif self.legacy_json_path and os.path.exists(self.legacy_json_path):
+            self.file_system.load_from_json(self.legacy_json_path)
+            self.compact()
+            print("[INFO] Sistema de archivos migrado de JSON al snapshot binario.")
+        else:
+            self.compact()
+            print("[INFO] No se encontró un snapshot, creando nuevo sistema de archivos.")
+
+        journal = self.file_system.journal
+        if journal is not None:
+            records = journal.replay(self.file_system.version)
+            for record in records:
+                self.file_system.apply(record)
+            if records:
+                print(f"[INFO] {len(records)} mutaciones recuperadas del journal (versión {self.file_system.version}).")
+
+    def compact(self, snapshot=None):
+        """Reescribe el snapshot (el árbol actual, o ``snapshot`` ya codificado) y vacía el journal."""
+        if snapshot is None:
+            snapshot = encode_snapshot(self.file_system.root, self.file_system.version)
+        write_snapshot(self.snapshot_path, snapshot)
+        if self.file_system.journal is not None:
+            self.file_system.journal.truncate()
+
+    def _compact_journal(self):
+        """Aplica el journal sobre el snapshot en disco y escribe el resultado como snapshot nuevo.
+
+        No lee el árbol en memoria, que sigue cambiando en el event loop: el
+        snapshot queda exactamente en la última versión publicada.
+        """
+        scratch = FileSystem()
+        scratch.set_root(*load_snapshot(self.snapshot_path))
+        for record in self.file_system.journal.replay(scratch.version):
+            scratch.apply(record)
+        self.compact(encode_snapshot(scratch.root, scratch.version))
+
+    async def _compact_if_needed(self):
+        """Compacta cuando el journal supera el umbral (con ``_publish_lock``: nadie más escribe el journal)."""
+        if self.file_system.journal.entries < self.compaction_threshold:
+            return
+        await asyncio.to_thread(self._compact_journal)
+        # Apoyar el árbol en el snapshot nuevo suelta el mapeo anterior y las marcas ``dirty``
+        self.file_system.set_root(*load_snapshot(self.snapshot_path, lazy=True))
+        self._reapply_unpublished()
+
+    def _reapply_unpublished(self):
+        """Vuelve a aplicar sobre un árbol recién cargado las mutaciones de los comandos en curso."""
+        for record in self.file_system.journal.unpublished():
+            self.file_system.apply({**record, "seq": 0})
+
+    async def _rebuild(self):
+        """Vuelve al árbol publicado (snapshot + journal) más lo que aún no publicaron los comandos en curso."""
+        root, version = await asyncio.to_thread(load_snapshot, self.snapshot_path, True, True)
+        records = await asyncio.to_thread(self.file_system.journal.replay, version)
+        self.file_system.set_root(root, version)
+        for record in records:
+            self.file_system.apply(record)
+        self._reapply_unpublished()
+
+    def start(self):
+        """Aplica y persiste en segundo plano los deltas a medida que llegan, aunque no haya comandos FTP."""
+        loop = asyncio.get_running_loop()
+        arrived = asyncio.Event()
+        self.dfs.on_delta = lambda: loop.call_soon_threadsafe(arrived.set)
+        arrived.set()  # Por si ya había alguno en cola
+        self._follower = asyncio.create_task(self._follow_deltas(arrived))
+
+    async def _follow_deltas(self, arrived):
+        while True:
+            await arrived.wait()
+            arrived.clear()
+            try:
+                async with self._publish_lock:
+                    await self._apply_incoming()
+            except Exception as e:
+                print(f"[ERROR] No se pudieron aplicar los deltas recibidos: {e}")
+
+    async def refresh(self):
+        """Asegura que el árbol en memoria esté al día. O(1) si no llegaron deltas."""
+        if self.dfs.incoming_deltas and not self._publish_lock.locked():
+            async with self._publish_lock:
+                await self._apply_incoming()
+
+        now = time.monotonic()
+        if now - self._last_remote_check >= self.check_interval and (self._remote_check is None or self._remote_check.done()):
+            self._last_remote_check = now
+            self._remote_check = asyncio.create_task(self._check_remote_version())
+
+    async def _apply_incoming(self):
+        """Aplica en orden los deltas recibidos de otros nodos."""
+        incoming = self.dfs.incoming_deltas
+        while incoming:
+            seq, records = incoming.popleft()
+            if seq > self.file_system.version + 1:
+                # Se perdió algún delta intermedio: pedir lo que falta
+                await self._catch_up()
+            if seq == self.file_system.version + 1:
+                try:
+                    released = self._apply_remote(records)
+                    await asyncio.to_thread(self.file_system.journal.extend, records)
+                    self._delete_blobs(released)
+                except Exception:
+                    # No se descarta: vuelve a la cola y el árbol regresa a lo que hay en disco
+                    incoming.appendleft((seq, records))
+                    await self._rebuild()
+                    raise
+        await self._compact_if_needed()
+
+    def _apply_remote(self, records):
+        """Aplica registros publicados por otro nodo y devuelve los blobs que dejaron de usarse.
+
+        Son las copias locales (traídas con ``fetch_blob``) de los archivos
+        que esos registros borraron o sustituyeron.
+        """
+        released = []
+        for record in records:
+            displaced = self.file_system.apply(record)
+            if displaced is None:
+                continue
+            current = None if record["op"] == "rm" else self.file_system.resolve_path(record.get("to", record["path"]))
+            in_use = {file.blob for file in iter_files(current)} if current is not None else set()
+            released.extend(file.blob for file in iter_files(displaced) if file.blob and file.blob not in in_use)
+        return released
+
+    def _delete_blobs(self, keys):
+        if self.blobs is not None:
+            for key in keys:
+                self.blobs.delete(key)
+
+    async def _catch_up(self, target=0):
+        """Trae de otro nodo los registros posteriores a la versión local (hasta ``target``, si se da).
+
+        Si el otro nodo ya los compactó, se recibe su snapshot (que sustituye
+        al local) junto con los registros posteriores a él. Devuelve si se
+        pudo actualizar.
+        """
+        result = await asyncio.to_thread(self.dfs.catch_up, self.file_system.version, target)
+        if result is None:
+            return False
+        kind, records = result
+        journal = self.file_system.journal
+        if kind == "snapshot":
+            self.file_system.set_root(*load_snapshot(self.snapshot_path, lazy=True))
+            await asyncio.to_thread(journal.truncate)
+        records = [record for record in records if record["seq"] > self.file_system.version]
+        try:
+            released = self._apply_remote(records)
+            if records:
+                await asyncio.to_thread(journal.extend, records)
+            self._delete_blobs(released)
+        except Exception:
+            await self._rebuild()  # Sin registros aplicados a medias
+            raise
+        if kind == "snapshot":
+            # Mutaciones de los comandos en curso, aún sin publicar: el árbol nuevo no las tiene
+            self._reapply_unpublished()
+        print(f"[INFO] Metadatos puestos al día ({kind}) hasta la versión {self.file_system.version}.")
+        return True
+
+    async def _check_remote_version(self):
+        try:
+            remote_version = await self.node.get(VERSION_KEY)
+            if remote_version is None or int(remote_version) <= self.file_system.version:
+                return
+            async with self._publish_lock:
+                await self._catch_up()
+        except Exception as e:
+            print(f"Error al consultar la versión replicada de los metadatos: {e}")
+
+    async def _acquire_commit_lock(self):
+        """Espera el turno de publicación del clúster (lo retienen solo mientras publican)."""
+        delay = 0.01
+        while True:
+            owner = await asyncio.to_thread(self.dfs.acquire_locks, COMMIT_LOCK)
+            if owner is not None:
+                return owner
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, COMMIT_RETRY_MAX_DELAY)
+
+    async def keep_lease(self, owner):
+        """Renueva los leases de ``owner`` mientras dure la tarea; quien los retiene la cancela al liberarlos."""
+        while True:
+            await asyncio.sleep(self.dfs.LEASE_RENEW_INTERVAL)
+            await asyncio.to_thread(self.dfs.renew_locks, owner)
+
+    def begin(self):
+        """Abre el ``Command`` que recoge las mutaciones del comando FTP de la tarea actual."""
+        return self.file_system.journal.begin()
+
+    async def end(self, command):
+        """Cierra ``command``: si no llegó a publicarse, deshace sus mutaciones y borra los blobs que creó.
+
+        Si se publicó, se borran los blobs que dejó de usar (hasta entonces
+        seguían referenciados por la versión anterior).
+        """
+        journal = self.file_system.journal
+        journal.end(command)
+        if command.published:
+            discarded = command.released
+        else:
+            if command.records:
+                async with self._publish_lock:
+                    await self._rebuild()
+                print(f"[INFO] Deshechas {len(command.records)} mutaciones sin publicar.")
+            discarded = command.created
+        self._delete_blobs(discarded)
+
+    async def publish(self, command=None):
+        """Registra las mutaciones de ``command`` como una nueva versión y replica solo ese delta.
+
+        Comandos sobre rutas distintas corren a la vez en distintos nodos, así
+        que la versión se asigna con el turno de publicación del clúster: antes
+        de numerar, se aplican los deltas de quien publicó justo antes. Si no
+        se llega a la última versión conocida se lanza ``StaleMetadataError``
+        sin numerar; ``end`` deshace entonces el comando.
+        """
+        journal = self.file_system.journal
+        pending = journal.pending if command is None else command.records
+        if not pending:
+            if command is not None:
+                command.published = True
+            return  # El comando no modificó el espacio de nombres
+        async with self._publish_lock:
+            owner = await self._acquire_commit_lock()
+            lease = asyncio.create_task(self.keep_lease(owner))
+            try:
+                await self._apply_incoming()
+                while self.dfs.known_version > self.file_system.version:
+                    behind = self.file_system.version
+                    await self._catch_up(self.dfs.known_version)
+                    if self.file_system.version == behind:
+                        raise StaleMetadataError(
+                            f"versión local {behind}, el clúster ya va por la {self.dfs.known_version}")
+                version = self.file_system.version + 1
+                records = await asyncio.to_thread(journal.write, pending, version)
+                self.file_system.version = version
+                journal.take(command)
+                if command is not None:
+                    command.published = True
+                # Con el turno retenido para que los deltas salgan en orden de versión
+                await asyncio.to_thread(self.dfs.propagate_delta, version, records, self.dfs.locks.token(owner))
+            finally:
+                lease.cancel()
+                await asyncio.to_thread(self.dfs.release_locks, owner)
+            await self._compact_if_needed()
+        try:
+            # Solo el número: basta para que un nodo atrasado sepa que debe ponerse al día
+            await self.node.set(VERSION_KEY, str(version).encode())
+        except Exception as e:
+            print(f"Error al replicar la versión de los metadatos: {e}")
@@ -0,0 +1,286 @@
+import itertools
+import json
+import socket
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, Future, InvalidStateError, ThreadPoolExecutor, wait
+
+# Protocolo entre nodos (puerto 6000): cada mensaje es un marco con una
+# cabecera binaria fija seguida del cuerpo JSON
+#
+#   versión (u8) | flags (u8) | id de la petición (u32) | longitud del cuerpo (u32)
+#
+# La respuesta lleva el id de su petición, así que varias peticiones pueden
+# estar en vuelo sobre la misma conexión (pipelining); el id 0 marca una
+# notificación, que no se responde. Los cuerpos grandes van comprimidos con
+# zlib (flag FLAG_COMPRESSED). Un mensaje de control pequeño es un único
+# ``sendall`` de unas decenas de bytes, es decir, un solo segmento.
+FRAME_HEADER = struct.Struct("!BBII")
+PROTOCOL_VERSION = 1
+FLAG_COMPRESSED = 0x01
+COMPRESS_THRESHOLD = 4096  # Cuerpos a partir de este tamaño se intentan comprimir
+NOTIFICATION_ID = 0
+
+SESSION_HELLO = {"type": "RPC_SESSION"}  # Primer marco de una conexión persistente
+
+CONNECT_TIMEOUT = 5
+REQUEST_TIMEOUT = 5
+CONNECT_WORKERS = 16  # Conexiones nuevas que se abren en paralelo
+
+
+def send_frame(sock, message, request_id=NOTIFICATION_ID):
+    body = json.dumps(message, separators=(",", ":")).encode()
+    flags = 0
+    if len(body) >= COMPRESS_THRESHOLD:
+        compressed = zlib.compress(body, 1)
+        if len(compressed) < len(body):
+            body, flags = compressed, FLAG_COMPRESSED
+    sock.sendall(FRAME_HEADER.pack(PROTOCOL_VERSION, flags, request_id, len(body)) + body)
+
+
+def _read_exactly(reader, size):
+    data = reader.read(size)
+    if len(data) < size:
+        raise ConnectionError("Conexión cerrada a mitad de un mensaje.")
+    return data
+
+
+def recv_frame(reader):
+    """Lee un marco de ``reader`` (``sock.makefile('rb')``) y devuelve ``(id, mensaje)``."""
+    version, flags, request_id, length = FRAME_HEADER.unpack(_read_exactly(reader, FRAME_HEADER.size))
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"Versión de protocolo desconocida: {version}")
+    body = _read_exactly(reader, length)
+    if flags & FLAG_COMPRESSED:
+        body = zlib.decompress(body)
+    return request_id, json.loads(body)
+
+
+def _resolve(future, result=None, exception=None):
+    """Completa ``future`` salvo que ya lo hayan cancelado."""
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class PeerConnection:
+    """Conexión persistente con un nodo, compartida por todos los hilos.
+
+    Los envíos se serializan con ``send_lock``; un hilo lector entrega cada
+    respuesta al ``Future`` de la petición con el mismo id. Si la conexión se
+    cae, las peticiones pendientes fallan con ``ConnectionError``. Quien deja
+    de esperar una respuesta cancela su ``Future``, que sale de ``pending``.
+    """
+    def __init__(self, address, on_close):
+        self.address = address
+        self.on_close = on_close
+        self.sock = socket.create_connection(address, timeout=CONNECT_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_frame(self.sock, SESSION_HELLO)
+        self.sock.settimeout(None)
+        self.reader = self.sock.makefile("rb")
+        self.send_lock = threading.Lock()
+        self.pending = {}  # id -> Future
+        self.pending_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.closed = False
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def request(self, message):
+        """Envía una petición y devuelve el ``Future`` de su respuesta."""
+        future = Future()
+        with self.pending_lock:
+            if self.closed:
+                future.set_exception(ConnectionError(f"Conexión con {self.address} cerrada."))
+                return future
+            request_id = next(self.ids) % 0xFFFFFFFF + 1  # u32 distinto de NOTIFICATION_ID
+            self.pending[request_id] = future
+        future.add_done_callback(lambda done: self._forget(request_id))
+        try:
+            self._send(message, request_id)
+        except OSError:
+            self.close()  # Falla también este Future
+        return future
+
+    def notify(self, message):
+        """Envía un mensaje sin esperar respuesta."""
+        try:
+            self._send(message, NOTIFICATION_ID)
+        except OSError:
+            self.close()
+            raise
+
+    def _forget(self, request_id):
+        """Olvida una petición respondida o cancelada (la respuesta tardía se ignora)."""
+        with self.pending_lock:
+            self.pending.pop(request_id, None)
+
+    def _send(self, message, request_id):
+        with self.send_lock:
+            send_frame(self.sock, message, request_id)
+
+    def _read_loop(self):
+        try:
+            while True:
+                request_id, message = recv_frame(self.reader)
+                with self.pending_lock:
+                    future = self.pending.pop(request_id, None)
+                # Si quien la pidió ya la canceló por timeout, la respuesta se descarta
+                if future is not None and future.set_running_or_notify_cancel():
+                    future.set_result(message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        with self.pending_lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ConnectionError(f"Conexión con {self.address} cerrada."))
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.on_close(self)
+
+
+class PeerPool:
+    """Conexiones persistentes con los demás nodos, abiertas bajo demanda y reutilizadas.
+
+    Las conexiones que aún no existen se abren en un pool de hilos, de modo
+    que un nodo caído (que tarda ``CONNECT_TIMEOUT`` en fallar) no retrasa a
+    los demás.
+    """
+    def __init__(self):
+        self.connections = {}  # (ip, puerto) -> PeerConnection
+        self.lock = threading.Lock()
+        self.connect_executor = ThreadPoolExecutor(max_workers=CONNECT_WORKERS, thread_name_prefix="peer-connect")
+
+    def get(self, address):
+        """Devuelve la conexión con ``address``, abriéndola si no existe (puede lanzar ``OSError``)."""
+        with self.lock:
+            connection = self.connections.get(address)
+        if connection is None:
+            connection = PeerConnection(address, self._discard)
+            with self.lock:
+                existing = self.connections.setdefault(address, connection)
+            if existing is not connection:
+                # Otro hilo la abrió a la vez: se usa la suya
+                connection.close()
+                connection = existing
+        return connection
+
+    def drop(self, address):
+        """Cierra la conexión con un nodo que dejó el clúster."""
+        with self.lock:
+            connection = self.connections.get(address)
+        if connection is not None:
+            connection.close()
+
+    def _discard(self, connection):
+        with self.lock:
+            if self.connections.get(connection.address) is connection:
+                del self.connections[connection.address]
+
+    def request(self, address, message, timeout=REQUEST_TIMEOUT):
+        """Petición a un solo nodo; devuelve su respuesta."""
+        future = self.get(address).request(message)
+        try:
+            return future.result(timeout)
+        finally:
+            future.cancel()  # Tras un timeout, libera su lugar en ``pending``
+
+    def _request_async(self, address, message):
+        """Como ``request`` pero sin bloquear: si hay que conectar, se hace en el pool de hilos."""
+        with self.lock:
+            connection = self.connections.get(address)
+        if connection is not None:
+            return connection.request(message)
+        future = Future()
+
+        def connect_and_request():
+            try:
+                inner = self.get(address).request(message)
+            except OSError as e:
+                _resolve(future, exception=e)
+                return
+            # Cancelar la petición exterior (timeout) cancela la que está en la conexión
+            future.add_done_callback(lambda outer: inner.cancel() if outer.cancelled() else None)
+
+            def relay(done):
+                if done.cancelled():
+                    return
+                if done.exception() is not None:
+                    _resolve(future, exception=done.exception())
+                else:
+                    _resolve(future, done.result())
+
+            inner.add_done_callback(relay)
+
+        self.connect_executor.submit(connect_and_request)
+        return future
+
+    def request_all(self, addresses, message, timeout=REQUEST_TIMEOUT, until=None):
+        """Envía ``message`` a todos los nodos a la vez y recoge las respuestas.
+
+        La ronda dura lo que tarde el nodo más lento (un RTT sobre conexiones
+        ya abiertas) y como mucho ``timeout`` segundos: los nodos caídos o que
+        no responden a tiempo se omiten. Si ``until(respuesta)`` es verdadero,
+        se deja de esperar a los demás (por ejemplo, ante una denegación).
+        """
+        deadline = time.monotonic() + timeout
+        pending = {self._request_async(address, message) for address in addresses}
+        responses = []
+        try:
+            while pending:
+                done, pending = wait(pending, max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+                if not done:
+                    break  # Plazo vencido
+                for future in done:
+                    if future.exception() is not None:
+                        continue
+                    response = future.result()
+                    responses.append(response)
+                    if until is not None and until(response):
+                        return responses
+            return responses
+        finally:
+            # Las que ya no se esperan dejan de ocupar ``pending`` en sus conexiones
+            for future in pending:
+                future.cancel()
+
+    def _notify(self, address, message):
+        try:
+            self.get(address).notify(message)
+        except OSError:
+            pass
+
+    def notify_all(self, addresses, message):
+        for address in addresses:
+            with self.lock:
+                connection = self.connections.get(address)
+            if connection is None:
+                self.connect_executor.submit(self._notify, address, message)
+            else:
+                try:
+                    connection.notify(message)
+                except OSError:
+                    pass
+
+    def close(self):
+        with self.lock:
+            connections = list(self.connections.values())
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,66 @@
+class FTPSession:
+    """Estado de transferencia propio de una conexión de control.
+
+    Cada cliente tiene su canal de datos, tipo de transferencia, punto de
+    reinicio y ruta pendiente de renombrar, de modo que sesiones concurrentes
+    no se pisan entre sí.
+    """
+    __slots__ = ("data_socket", "data_type", "restart_point", "path_to_change", "archive_format")
+
+    def __init__(self):
+        self.data_socket = None
+        self.data_type = 'ASCII'
+        self.restart_point = 0
+        self.path_to_change = None
+        self.archive_format = 'ZIP'  # Formato de descarga de directorios (SITE ARCHIVE)
+
+    def set_data_channel(self, channel):
+        """Sustituye el canal de datos, cerrando el anterior si existía."""
+        self.close_data_channel()
+        self.data_socket = channel
+
+    def close_data_channel(self):
+        if self.data_socket:
+            self.data_socket.close()
+            self.data_socket = None
+
+    def reset(self):
+        """Restablece el estado de transferencia (REIN)."""
+        self.close_data_channel()
+        self.data_type = 'ASCII'
+        self.restart_point = 0
+        self.path_to_change = None
+        self.archive_format = 'ZIP'
+
+
+class DeferredReplies:
+    """Conexión de control de un comando mutante que retiene su respuesta final.
+
+    Las respuestas preliminares (1xx) salen en el acto; las demás esperan a
+    que el comando se publique: ``flush`` las envía y ``abort`` las sustituye
+    por otra respuesta si no se pudo publicar.
+    """
+    __slots__ = ("writer", "held")
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.held = []
+
+    def write(self, message):
+        if message.startswith(b"1"):
+            self.writer.write(message)
+        else:
+            self.held.append(message)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def flush(self):
+        self.writer.write(b"".join(self.held))
+        self.held.clear()
+        await self.writer.drain()
+
+    async def abort(self, message):
+        self.held.clear()
+        self.writer.write(message)
+        await self.writer.drain()
@@ -0,0 +1,178 @@
+import mmap
+import os
+import struct
+import sys
+
+from filesystem import File, Directory
+
+# Formato binario del snapshot del espacio de nombres:
+#
+#   cabecera   MAGIC | versión (u64) | desplazamiento del directorio raíz (u64)
+#   bloques    un bloque por directorio, escrito en post-orden (hijos antes que el padre)
+#
+# Cada bloque de directorio empieza con (entradas, created_at, permisos, nlink)
+# y sigue con sus entradas: tipo + nombre y, para archivos, sus metadatos, o
+# para subdirectorios el desplazamiento de su bloque y sus metadatos. Así un
+# directorio se puede decodificar (y listar) sin leer el resto del árbol, lo
+# que permite materializarlo bajo demanda.
+MAGIC = b"DFTPSNP2"
+HEADER = struct.Struct("<8sQQ")
+DIR_HEADER = struct.Struct("<IqHI")
+ENTRY = struct.Struct("<BH")  # tipo, longitud del nombre
+FILE_FIELDS = struct.Struct("<qqHIQBI")  # created, modified, permisos, nlink, tamaño, len(blob), len(contenido)
+CHILD_FIELDS = struct.Struct("<QqHI")  # desplazamiento del bloque, created, permisos, nlink
+
+KIND_FILE = 0
+KIND_DIRECTORY = 1
+
+
+def encode_snapshot(root, version):
+    """Serializa el árbol ``root`` con su ``version`` y devuelve los bytes del snapshot.
+
+    Recorre el árbol sin recursión; cada directorio se escribe después de sus
+    subdirectorios para conocer ya sus desplazamientos.
+    """
+    out = bytearray(HEADER.size)
+    offsets = {}
+    stack = [(root, None)]
+    while stack:
+        directory, contents = stack.pop()
+        if contents is None:
+            # Los directorios sin materializar se decodifican aparte, sin engancharlos al árbol
+            contents = directory.peek_contents()
+            stack.append((directory, contents))
+            stack.extend((child, None) for child in contents.values() if isinstance(child, Directory))
+            continue
+
+        offsets[id(directory)] = len(out)
+        out += DIR_HEADER.pack(len(contents), int(directory.created_at), directory.permissions, directory.nlink)
+        for name, item in contents.items():
+            encoded_name = name.encode()
+            if isinstance(item, File):
+                blob = item.blob.encode() if item.blob else b""
+                content = item.content.encode() if isinstance(item.content, str) else item.content
+                out += ENTRY.pack(KIND_FILE, len(encoded_name))
+                out += encoded_name
+                out += FILE_FIELDS.pack(int(item.created_at), int(item.modified_at), item.permissions,
+                                        item.nlink, item.size, len(blob), len(content))
+                out += blob
+                out += content
+            else:
+                out += ENTRY.pack(KIND_DIRECTORY, len(encoded_name))
+                out += encoded_name
+                out += CHILD_FIELDS.pack(offsets.pop(id(item)), int(item.created_at), item.permissions, item.nlink)
+
+    HEADER.pack_into(out, 0, MAGIC, version, offsets[id(root)])
+    return bytes(out)
+
+
+def write_snapshot(path, data):
+    """Escribe el snapshot ``data`` en ``path`` de forma atómica."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_header(buffer):
+    """Devuelve ``(versión, desplazamiento de la raíz)`` de un snapshot."""
+    magic, version, root_offset = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("No es un snapshot binario del sistema de archivos.")
+    return version, root_offset
+
+
+def read_snapshot_version(path):
+    """Lee solo la versión de un snapshot en disco, sin decodificar el árbol."""
+    with open(path, "rb") as f:
+        return read_header(f.read(HEADER.size))[0]
+
+
+def decode_directory(buffer, offset, directory, lazy=False):
+    """Decodifica el bloque en ``offset`` dentro de ``directory``.
+
+    Con ``lazy`` los subdirectorios quedan sin materializar (se decodifican al
+    acceder a su ``contents``); si no, devuelve la lista ``(subdirectorio,
+    desplazamiento de su bloque)`` de los hijos que quedan por decodificar.
+    """
+    count, directory.created_at, directory.permissions, directory.nlink = DIR_HEADER.unpack_from(buffer, offset)
+    offset += DIR_HEADER.size
+    contents = directory.contents
+    pending = []
+    for _ in range(count):
+        kind, name_length = ENTRY.unpack_from(buffer, offset)
+        offset += ENTRY.size
+        name = sys.intern(str(buffer[offset:offset + name_length], "utf-8"))
+        offset += name_length
+        if kind == KIND_FILE:
+            created_at, modified_at, permissions, nlink, size, blob_length, content_length = FILE_FIELDS.unpack_from(buffer, offset)
+            offset += FILE_FIELDS.size
+            file = File.__new__(File)
+            file.name = name
+            file.created_at = created_at
+            file.modified_at = modified_at
+            file.permissions = permissions
+            file.nlink = nlink
+            file.size = size
+            file.blob = str(buffer[offset:offset + blob_length], "ascii") if blob_length else None
+            offset += blob_length
+            file.content = str(buffer[offset:offset + content_length], "utf-8") if content_length else ""
+            offset += content_length
+            contents[name] = file
+        else:
+            child_offset, created_at, permissions, nlink = CHILD_FIELDS.unpack_from(buffer, offset)
+            offset += CHILD_FIELDS.size
+            child = Directory(name)
+            child.created_at = created_at
+            child.permissions = permissions
+            child.nlink = nlink
+            contents[name] = child
+            if lazy:
+                child._contents = None
+                child._source = (decode_lazy_directory, buffer, child_offset)
+            else:
+                pending.append((child, child_offset))
+    return pending
+
+
+def decode_lazy_directory(buffer, offset, directory):
+    """Decodificador que usan los directorios sin materializar."""
+    decode_directory(buffer, offset, directory, lazy=True)
+
+
+def decode_snapshot(buffer, lazy=False):
+    """Reconstruye el árbol de un snapshot sin recursión. Devuelve ``(raíz, versión)``.
+
+    Con ``lazy`` solo se prepara la raíz; cada directorio se decodifica la
+    primera vez que se accede a él, leyendo de ``buffer``.
+    """
+    version, root_offset = read_header(buffer)
+    root = Directory("/")
+    if lazy:
+        root._contents = None
+        root._source = (decode_lazy_directory, buffer, root_offset)
+        return root, version
+    stack = [(root, root_offset)]
+    while stack:
+        directory, offset = stack.pop()
+        stack.extend(decode_directory(buffer, offset, directory))
+    return root, version
+
+
+def load_snapshot(path, use_mmap=True, lazy=False):
+    """Carga un snapshot desde disco, mapeándolo en memoria si ``use_mmap``.
+
+    Con ``lazy`` el mapeo queda abierto mientras haya directorios sin
+    materializar que lo referencien; sustituir el archivo (``os.replace``) no
+    lo invalida.
+    """
+    with open(path, "rb") as f:
+        if use_mmap and os.fstat(f.fileno()).st_size:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if lazy:
+                return decode_snapshot(buffer, lazy=True)
+            with buffer:
+                return decode_snapshot(buffer)
+        return decode_snapshot(f.read(), lazy)
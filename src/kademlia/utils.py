@@ -38,4 +38,17 @@ def shared_prefix(args):
 
 def bytes_to_bit_string(bites):
     bits = [bin(bite)[2:].rjust(8, '0') for bite in bites]
-    return "".join(bits)
\ No newline at end of file
+    return "".join(bits)
+
+
+def value_size(value):
+    """
+    Approximate number of bytes a DHT value takes in an RPC message.
+    """
+    if value is None:
+        return 1
+    if isinstance(value, str):
+        return len(value.encode()) + 5
+    if isinstance(value, bytes):
+        return len(value) + 5
+    return 9
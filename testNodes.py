@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import argparse
 import os
 import io
@@ -11,9 +12,28 @@ import stat
 import json
 import socket
 import uuid
+import hashlib
 
 
 FILESYSTEM_JSON = "filesystem.json"
+
+# Los archivos se guardan en Kademlia como un manifiesto bajo la clave del
+# archivo más sus pedazos bajo "chunk <SHA-256 del pedazo>": un mismo
+# contenido se guarda una sola vez aunque aparezca en varios archivos. Los
+# cortes entre pedazos dependen del contenido (hash rodante), así que editar
+# un archivo solo cambia los pedazos que rodean la edición. Cada valor viaja
+# en un solo mensaje de rpcudp, que no admite más de 8 KB entre nombre y
+# argumentos.
+MAX_CHUNK_SIZE = 7 * 1024
+DEFAULT_CHUNK_SIZE = MAX_CHUNK_SIZE  # Tamaño máximo de un pedazo; el promedio ronda la mitad
+DEFAULT_CONCURRENCY = 16  # Pedazos pedidos por adelantado al descargar
+MANIFEST_PAGE_SIZE = 80  # Pedazos por página del manifiesto (cada página es un valor aparte)
+TRANSFER_RETRIES = 3  # Intentos para cada pedazo que no se pudo subir o bajar
+FETCH_BATCH = 8  # Pedazos consecutivos pedidos juntos con get_many
+# Tabla del hash rodante (gear): fija, para que todos los nodos corten igual
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "big") for i in range(256)]
+CHUNK_SIZE = DEFAULT_CHUNK_SIZE
+TRANSFER_CONCURRENCY = DEFAULT_CONCURRENCY
 class File:
     """Representa un archivo en el sistema de archivos."""
     def __init__(self, name,key ,content="",permissions=0o644):
@@ -233,6 +253,175 @@ async def retrieve_data(node, key):
     value = await node.get(key)
     return value
 
+def split_chunks(content, max_size=None):
+    """Corta ``content`` en pedazos de tamaño variable según su contenido (hash gear, como FastCDC).
+
+    Se corta donde los bits altos del hash de los últimos 32 bytes son cero,
+    con pedazos de entre ``max_size / 4`` y ``max_size`` bytes.
+    """
+    max_size = min(max_size or CHUNK_SIZE, MAX_CHUNK_SIZE)
+    min_size = max_size // 4
+    bits = (max_size // 4).bit_length()  # Un corte cada ~2**bits bytes pasado el mínimo
+    mask = ((1 << bits) - 1) << (32 - bits)
+    chunks = []
+    start = 0
+    length = len(content)
+    while start < length:
+        end = min(start + max_size, length)
+        position = start + min_size
+        h = 0
+        while position < end:
+            h = ((h << 1) + GEAR[content[position]]) & 0xFFFFFFFF
+            position += 1
+            if not h & mask:
+                end = position
+                break
+        chunks.append(content[start:end])
+        start = end
+    return chunks
+
+def chunk_key(digest):
+    return f"chunk {digest}"
+
+async def gather_window(coroutines, window=None):
+    """Como ``asyncio.gather``, pero con a lo sumo ``window`` (``TRANSFER_CONCURRENCY``) en curso a la vez."""
+    slots = asyncio.Semaphore(window or TRANSFER_CONCURRENCY)
+
+    async def run(coroutine):
+        async with slots:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
+
+async def store_values(store, items, file_key):
+    """Guarda ``items`` con ``store`` (que dice si se guardó cada uno); si alguna petición UDP se pierde, se reintentan las fallidas."""
+    for _ in range(TRANSFER_RETRIES):
+        results = await store(items)
+        items = [item for item, stored in zip(items, results) if not stored]
+        if not items:
+            return
+    raise ValueError(f"No se pudieron guardar {len(items)} pedazos de {file_key}")
+
+async def store_file(node, file_key, content, chunk_size=None):
+    """Sube los pedazos nuevos de ``content`` en paralelo y luego su manifiesto.
+
+    Los pedazos que ya figuraban en la versión anterior del archivo, o que se
+    repiten dentro de él, no se vuelven a subir. El manifiesto se escribe al
+    final: un lector nunca ve un archivo a medias.
+    """
+    chunks = await asyncio.to_thread(split_chunks, content, chunk_size)  # Hashear el contenido bloquearía el event loop
+    entries = [[hashlib.sha256(chunk).hexdigest(), len(chunk)] for chunk in chunks]
+    pages = [entries[i:i + MANIFEST_PAGE_SIZE] for i in range(0, len(entries), MANIFEST_PAGE_SIZE)]
+
+    try:
+        previous = await read_manifest(node, file_key)
+    except ValueError as e:
+        # Sin la versión anterior completa no se sabe qué pedazos existen: se suben todos
+        print(f"Manifiesto anterior ilegible ({e}); se sube {file_key} completo")
+        previous = None
+    known = {key for key, _, _ in previous or ()}
+    items = {}
+    for (digest, _), chunk in zip(entries, chunks):
+        if chunk_key(digest) not in known:
+            items[chunk_key(digest)] = chunk
+    # Un pedazo no cambia nunca (su clave es su hash), así que se agrupan por
+    # nodo destino con set_many. Las páginas del manifiesto se reescriben en
+    # cada versión: van con set, que busca en la red los nodos más cercanos.
+    await store_values(node.set_many, list(items.items()), file_key)
+    pages = [(f"{file_key} manifest {index}", json.dumps(page).encode()) for index, page in enumerate(pages)]
+    # Cada ``set`` es una búsqueda iterativa completa: se acotan como los pedazos
+    await store_values(lambda items: gather_window(node.set(key, value) for key, value in items), pages, file_key)
+
+    manifest = {"manifest": 2, "size": len(content), "chunks": len(chunks), "pages": len(pages)}
+    await node.set(file_key, json.dumps(manifest).encode())
+
+def parse_manifest(value):
+    try:
+        manifest = json.loads(value)
+    except (TypeError, ValueError):
+        return None
+    return manifest if isinstance(manifest, dict) and manifest.get("manifest") in (1, 2) else None
+
+async def read_manifest(node, file_key):
+    """Pedazos de ``file_key`` como ``(clave, tamaño, SHA-256)``, en orden; ``None`` si no tiene manifiesto.
+
+    La versión 1 guardaba pedazos de tamaño fijo bajo "<clave> <índice>"; la
+    2, pedazos direccionados por contenido.
+    """
+    manifest = parse_manifest(await node.get(file_key))
+    if manifest is None:
+        return None
+    pages = await gather_window(node.get(f"{file_key} manifest {i}") for i in range(manifest["pages"]))
+    if any(page is None for page in pages):
+        raise ValueError(f"Manifiesto de {file_key} incompleto")
+    entries = [entry for page in pages for entry in json.loads(page)]
+    if manifest["manifest"] == 1:
+        chunk_size = manifest["chunk_size"]
+        return [(f"{file_key} {i}", min(chunk_size, manifest["size"] - i * chunk_size), digest)
+                for i, digest in enumerate(entries)]
+    return [(chunk_key(digest), size, digest) for digest, size in entries]
+
+async def fetch_chunk(node, key, expected):
+    """Pide un pedazo y verifica su SHA-256, reintentando si no llega o llega corrupto."""
+    for _ in range(TRANSFER_RETRIES):
+        chunk = await node.get(key)
+        if chunk is not None and hashlib.sha256(chunk).hexdigest() == expected:
+            return chunk
+    raise ValueError(f"Pedazo {key} ausente o corrupto")
+
+async def fetch_chunks(node, entries):
+    """Pide juntos los pedazos de ``entries``; los que no llegan o no coinciden se piden de a uno."""
+    chunks = await node.get_many([key for key, _, _ in entries])
+    for index, (chunk, (key, _, digest)) in enumerate(zip(chunks, entries)):
+        if chunk is None or hashlib.sha256(chunk).hexdigest() != digest:
+            chunks[index] = await fetch_chunk(node, key, digest)
+    return chunks
+
+async def iter_file(node, file_key, start=0, window=None):
+    """Produce el contenido de un archivo en orden, a partir del byte ``start``.
+
+    Con manifiesto se mantienen ``window`` pedazos pedidos en vuelo, en lotes
+    de ``FETCH_BATCH`` (lectura anticipada): el primer lote llega tras una
+    petición y los siguientes ya están en camino, y nunca hay más de
+    ``window`` pedazos en memoria. Los
+    archivos en el formato antiguo se leen pedazo a pedazo hasta el primero
+    que falte.
+    """
+    window = window or TRANSFER_CONCURRENCY
+    manifest = await read_manifest(node, file_key)
+    if manifest is None:
+        # Archivos guardados antes del manifiesto: pedazos consecutivos hasta el primero que falte
+        index = 0
+        chunk = await node.get(f"{file_key} {index}")
+        while chunk:
+            if start < len(chunk):
+                yield chunk[start:]
+            start = max(start - len(chunk), 0)
+            index += 1
+            chunk = await node.get(f"{file_key} {index}")
+        return
+
+    # Los pedazos enteros anteriores a ``start`` ni se piden: se saltan acumulando
+    # el tamaño de cada pedazo según el manifiesto (no hay un tamaño fijo de pedazo)
+    next_index = 0
+    while next_index < len(manifest) and start >= manifest[next_index][1]:
+        start -= manifest[next_index][1]
+        next_index += 1
+    pending = collections.deque()
+    try:
+        while next_index < len(manifest) or pending:
+            while next_index < len(manifest) and len(pending) * FETCH_BATCH < window:
+                batch = manifest[next_index:next_index + FETCH_BATCH]
+                pending.append(asyncio.ensure_future(fetch_chunks(node, batch)))
+                next_index += len(batch)
+            for chunk in await pending.popleft():
+                yield chunk[start:]
+                start = 0
+    finally:
+        # Si el cliente corta la transferencia se cancelan los pedidos en vuelo
+        for task in pending:
+            task.cancel()
+
 async def handle_client(reader, writer, node: Server, fileSystem:FileSystem):
     """Handles remote commands sent via socket"""
     addr = writer.get_extra_info("peername") #<---------------
@@ -416,31 +605,31 @@ async def handle_client(reader, writer, node: Server, fileSystem:FileSystem):
                     # Recibir los datos del cliente en memoria
                     file_buffer = io.BytesIO()
                     while True:
-                        up_data = reader_N.read(1024)
+                        up_data = await reader_N.read(1024)
                         if not up_data:
                             break
                         file_buffer.write(up_data)
                     writer_N.close()
                     await writer_N.wait_closed()
 
-                    file_buffer.seek(0)
-                    content = file_buffer.getvalue().decode() if data_type == "ASCII" else file_buffer.getvalue()
+                    content = file_buffer.getvalue()  # se mantiene como bytes, igual que en STOR
 
                     # Verificar si el archivo existe en el sistema de archivos virtual
                     file = fileSystem.resolve_path(resolved_path)
 
                     if file and isinstance(file, File):
-                        existing_content = await node.get(file.key)  # Agregar contenido al final del archivo existente
-                        concatenated_content = existing_content + content
-                        await node.set(file.key, concatenated_content)
+                        # La clave guarda el manifiesto: se arma el contenido actual y se sube una
+                        # versión nueva (los pedazos que no cambian no se vuelven a subir)
+                        existing_content = b"".join([chunk async for chunk in iter_file(node, file.key)])
+                        await store_file(node, file.key, existing_content + content)
                     else:
                         # Si el archivo no existe, crearlo
                         parent_directory = fileSystem.resolve_path(current_dir)
                         if parent_directory and isinstance(parent_directory, Directory):
-                            new_file = File(name=filename, content=content,key=filename+parent_directory.name)
+                            new_file = File(name=filename, content="dummy", key=resolved_path)
                             parent_directory.contents[filename] = new_file
                             fileSystem.path_map[resolved_path] = new_file
-                            await node.set(new_file.key, content)
+                            await store_file(node, new_file.key, content)
                         else:
                             writer.write(b'550 Failed to append file.\r\n')
                             print(f'Error appending file: {e}')
@@ -533,29 +722,15 @@ async def handle_client(reader, writer, node: Server, fileSystem:FileSystem):
                         
                         file_key= item.key
                         
-                        #!Aqui debe ir el codigo nuevo para obtener el contenido del archivo del nodo kademlia
+                        # Los pedazos se piden a Kademlia con lectura anticipada y se
+                        # envían al cliente en orden a medida que llegan
                         print("antes de La key")
-                        file_buffer=io.BytesIO()
-                        index=0
-                        file_content = await node.get(f"{file_key} {index}")
-                        while file_content:
-                            file_buffer.write(file_content)
-                            
-                            index+=1
-                            file_content = await node.get(f"{file_key} {index}")
-                        
-                        file_buffer.seek(0)
-                        file_content=file_buffer.getvalue()
-                        print("LLego la key")
-                        if data_type != 'Binary':
-                            file_content = file_content.decode()
-                        
-                        chunk_size = 1024
                         start_position = restart_point
                         restart_point = 0  # Resetear el punto de reinicio
 
-                        for i in range(start_position, len(file_content), chunk_size):
-                            writer_N.write(file_content[i:i + chunk_size])
+                        async for file_content in iter_file(node, file_key, start_position):
+                            writer_N.write(file_content)
+                            await writer_N.drain()
 
                         
 
@@ -602,8 +777,8 @@ async def handle_client(reader, writer, node: Server, fileSystem:FileSystem):
                         writer.write(b'550 Failed to store file.\r\n')
                     else:
                         
-                        #!Se debe analizar bien que key mandar aqui
-                        file_key=filename+parent_directory.name
+                        # La ruta completa identifica al archivo (el contenido va aparte, por hash)
+                        file_key=resolved_path
                         # Crear el objeto File en memoria
                         new_file = File(name=filename,content="dummy",key = file_key)
                         
@@ -615,14 +790,8 @@ async def handle_client(reader, writer, node: Server, fileSystem:FileSystem):
                         fileSystem.save_to_json(FILESYSTEM_JSON)
                         print("se guardo el json")
                         
-                        chunk_size = 1024
-                        #ahora itero por pedazos de bytes par ir guardandolos en en la red de kademlia
-                        count=0
-                        for i in range(0, len(content), chunk_size):
-                            chunk = content[i:i + chunk_size]
-                            chunk_key = f"{file_key} {count}"
-                            await node.set(chunk_key, chunk)
-                            count+=1
+                        # Los pedazos se suben en paralelo (con concurrencia acotada) y luego el manifiesto
+                        await store_file(node, file_key, content)
                         
                         
                         #!hay que guardar tambien el json del fileSystem
@@ -1146,6 +1315,12 @@ if __name__ == "__main__":
     parser.add_argument("--command_port", type=int, required=True, help="Port to receive FTP client-like commands")
     parser.add_argument("--bootstrap_ip", type=str, help="Bootstrap node IP")
     parser.add_argument("--bootstrap_port", type=int, help="Bootstrap node Port")
+    parser.add_argument("--chunk_size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"Maximum bytes per content-defined chunk (at most {MAX_CHUNK_SIZE}, one rpcudp message)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Chunks requested ahead while downloading (read-ahead window)")
 
     args = parser.parse_args()
+    CHUNK_SIZE = min(args.chunk_size, MAX_CHUNK_SIZE)
+    TRANSFER_CONCURRENCY = args.concurrency
     asyncio.run(run_node(args.port, args.command_port, args.bootstrap_ip, args.bootstrap_port))